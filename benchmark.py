@@ -0,0 +1,325 @@
+import argparse
+import collections
+import contextlib
+import copy
+import io
+import json
+import os
+import random
+import threading
+import time
+
+import boto3
+import credstash
+from kubernetes.client.rest import ApiException
+from moto import mock_aws
+
+from controller import AsyncCredStashController, CredStashController
+
+REGION = "us-east-1"
+TABLE = "credential-store"
+
+
+def merge(current, changes):
+    merged = dict(current or {})
+    for key, value in changes.items():
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = value
+    return merged
+
+
+class FakeCoreV1Api:
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.resource_version = 0
+        self._lock = threading.Lock()
+        self._secrets = {}
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _store(self, namespace, secret_obj):
+        secret_obj = copy.deepcopy(secret_obj)
+        with self._lock:
+            self.resource_version += 1
+            secret_obj.metadata.resource_version = str(self.resource_version)
+            self._secrets[namespace, secret_obj.metadata.name] = secret_obj
+        return copy.deepcopy(secret_obj)
+
+    def read_namespaced_secret(self, name, namespace):
+        self._call("read_namespaced_secret")
+        try:
+            return copy.deepcopy(self._secrets[namespace, name])
+        except KeyError:
+            raise ApiException(status=404)
+
+    def create_namespaced_secret(self, namespace, body):
+        self._call("create_namespaced_secret")
+        return self._store(namespace, body)
+
+    def patch_namespaced_secret(self, name, namespace, body):
+        self._call("patch_namespaced_secret")
+        with self._lock:
+            secret_obj = copy.deepcopy(self._secrets[namespace, name])
+        # Applied like the API server applies a merge patch
+        for field, changes in body.get("metadata", {}).items():
+            setattr(
+                secret_obj.metadata,
+                field,
+                merge(getattr(secret_obj.metadata, field), changes),
+            )
+        secret_obj.data = merge(secret_obj.data, body.get("data", {}))
+        return self._store(namespace, secret_obj)
+
+    def delete_namespaced_secret(self, name, namespace, body):
+        self._call("delete_namespaced_secret")
+        with self._lock:
+            self._secrets.pop((namespace, name), None)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def make_workload(crs, keys_per_cr, shared, seed=0):
+    rng = random.Random(seed)
+    shared_keys = ["shared-{}".format(i) for i in range(keys_per_cr * 2)]
+    keys = set()
+    events = []
+    for cr in range(crs):
+        spec = []
+        for entry in range(keys_per_cr):
+            if rng.random() < shared:
+                key = rng.choice(shared_keys)
+            else:
+                key = "cr{}-key{}".format(cr, entry)
+            keys.add(key)
+            spec.append(
+                {
+                    "name": "ENTRY_{}".format(entry),
+                    "from": key,
+                    "version": credstash.paddedInt(1),
+                }
+            )
+        events.append(
+            {
+                "type": "ADDED",
+                "object": {
+                    "metadata": {
+                        "namespace": "bench{}".format(cr % 10),
+                        "name": "secret{}".format(cr),
+                        "resourceVersion": str(cr + 1),
+                    },
+                    "spec": spec,
+                },
+            }
+        )
+    return sorted(keys), events
+
+
+def setup_credstash(secrets):
+    # secrets are (table, key, version)
+    session = boto3.Session(
+        aws_access_key_id="bench",
+        aws_secret_access_key="bench",
+        region_name=REGION,
+    )
+    credstash.get_session._cached_session = session
+    kms = session.client("kms")
+    key_id = kms.create_key()["KeyMetadata"]["KeyId"]
+    kms.create_alias(AliasName="alias/credstash", TargetKeyId=key_id)
+    for table in sorted({table for table, _, _ in secrets}):
+        credstash.createDdbTable(region=REGION, table=table)
+    for table, key, version in secrets:
+        credstash.putSecret(
+            key,
+            "value-of-" + key,
+            version=version,
+            region=REGION,
+            table=table,
+        )
+
+
+ENGINES = {"threads": CredStashController, "asyncio": AsyncCredStashController}
+
+
+def time_events(controller):
+    latencies = []
+    if isinstance(controller, AsyncCredStashController):
+        process_event_async = controller.process_event_async
+
+        async def timed_process_event_async(event, resource_version=None):
+            started = time.monotonic()
+            await process_event_async(event, resource_version)
+            latencies.append(time.monotonic() - started)
+
+        controller.process_event_async = timed_process_event_async
+    else:
+        process_event = controller.process_event
+
+        def timed_process_event(event, resource_version=None):
+            started = time.monotonic()
+            process_event(event, resource_version)
+            latencies.append(time.monotonic() - started)
+
+        controller.process_event = timed_process_event
+    return latencies
+
+
+def count_aws_calls(controller, latency=0):
+    aws_calls = collections.Counter()
+
+    def before_call(model, **kwargs):
+        service = model.service_model.service_name
+        aws_calls[service + ":" + model.name] += 1
+        if latency:
+            time.sleep(latency)
+
+    controller.aws_session().events.register("before-call", before_call)
+    return aws_calls
+
+
+def run_events(controller, events):
+    latencies = time_events(controller)
+    controller.start_workers()
+    started = time.monotonic()
+    for event in events:
+        controller.enqueue_event(
+            event, event["object"]["metadata"].get("resourceVersion")
+        )
+    controller.queue.join()
+    return time.monotonic() - started, latencies
+
+
+def run_benchmark(
+    crs=100,
+    keys_per_cr=10,
+    shared=0.5,
+    workers=4,
+    fetch_workers=8,
+    aws_latency=0,
+    api_latency=0,
+    controller_factory=CredStashController,
+    rate_limits=None,
+):
+    keys, events = make_workload(crs, keys_per_cr, shared)
+    with mock_aws():
+        setup_credstash(
+            [(TABLE, key, credstash.paddedInt(1)) for key in keys]
+        )
+        controller = controller_factory(
+            "bench",
+            "bench",
+            REGION,
+            TABLE,
+            "*",
+            fetch_workers=fetch_workers,
+            workers=workers,
+            rate_limits=rate_limits,
+        )
+        controller.v1core = FakeCoreV1Api(api_latency)
+        aws_calls = count_aws_calls(controller, aws_latency)
+        elapsed, latencies = run_events(controller, events)
+        credstash.get_session._cached_session = None
+
+    return {
+        "crs": crs,
+        "keys_per_cr": keys_per_cr,
+        "distinct_keys": len(keys),
+        "events": len(events),
+        "seconds": round(elapsed, 3),
+        "events_per_second": round(len(events) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "kubernetes_calls": dict(controller.v1core.calls),
+        "aws_calls": dict(aws_calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the controller against local stand-ins"
+    )
+    parser.add_argument("--crs", type=int, default=100)
+    parser.add_argument("--keys", type=int, default=10)
+    parser.add_argument(
+        "--shared",
+        type=float,
+        default=0.5,
+        help="Fraction of entries that use a key shared between secrets",
+    )
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="threads")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--fetch-workers", type=int, default=8)
+    parser.add_argument(
+        "--aws-latency",
+        type=float,
+        default=0,
+        help="Seconds added to every DynamoDB and KMS call",
+    )
+    parser.add_argument(
+        "--api-latency",
+        type=float,
+        default=0,
+        help="Seconds added to every Kubernetes API call",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        action="append",
+        default=[],
+        metavar="BACKEND=RATE",
+        help="Calls per second to dynamodb, kms or kubernetes, 0 for none",
+    )
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the controller's output"
+    )
+    args = parser.parse_args()
+    rate_limits = {}
+    for rate_limit in args.rate_limit:
+        backend, rate = rate_limit.split("=")
+        rate_limits[backend] = float(rate)
+
+    # moto never talks to AWS, but boto3 still wants credentials
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+    output = io.StringIO()
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(output))
+        result = run_benchmark(
+            crs=args.crs,
+            keys_per_cr=args.keys,
+            shared=args.shared,
+            workers=args.workers,
+            fetch_workers=args.fetch_workers,
+            aws_latency=args.aws_latency,
+            api_latency=args.api_latency,
+            controller_factory=ENGINES[args.engine],
+            rate_limits=rate_limits,
+        )
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return
+    print(
+        "{events} events ({crs} secrets x {keys_per_cr} keys, "
+        "{distinct_keys} distinct) in {seconds}s".format(**result)
+    )
+    print("{events_per_second} events/s".format(**result))
+    print("p50 {p50_ms}ms, p99 {p99_ms}ms".format(**result))
+    for kind in ("kubernetes_calls", "aws_calls"):
+        for call, count in sorted(result[kind].items()):
+            print("{:>8} {}".format(count, call))
+
+
+if __name__ == "__main__":
+    main()
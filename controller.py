@@ -1,20 +1,599 @@
+import asyncio
 import base64
+import bisect
+import boto3
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import credstash
+import datetime
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
 import os
+import random
+import signal
+import threading
+import time
 import traceback
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from kubernetes import client, config, watch
-from kubernetes.client import V1DeleteOptions, V1ObjectMeta
+from kubernetes.client import V1DeleteOptions, V1ObjectMeta, V1OwnerReference
 from kubernetes.client.rest import ApiException
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 
 DOMAIN = "credstash.local"
 api_version = "v1"
+PLURAL = "credstashsecrets"
+KIND = "CredStashSecret"
+
+WATCH_RETRY_DELAY = 1
+LIST_PAGE_SIZE = 500
+SECRET_SYNC_TIMEOUT = 30
+
+MANAGED_LABEL = "credstash.local/managed"
+SHARD_LABEL = "credstash.local/shard-member"
+LEASE_PATH = "/apis/coordination.k8s.io/v1/namespaces/{namespace}/leases"
+
+CREDSTASH_SECONDS = Histogram(
+    "credstash_controller_credstash_seconds",
+    "Time spent in credstash, DynamoDB and KMS calls",
+    ["call"],
+)
+SECRET_API_SECONDS = Histogram(
+    "credstash_controller_secret_api_seconds",
+    "Time spent in Kubernetes Secret API calls",
+    ["call"],
+)
+EVENT_SECONDS = Histogram(
+    "credstash_controller_event_seconds",
+    "Time spent handling a CredStashSecret event",
+    ["type"],
+)
+EVENTS = Counter(
+    "credstash_controller_events_total",
+    "CredStashSecret events handled",
+    ["type", "outcome"],
+)
+EVENTS_ALREADY_PROCESSED = Counter(
+    "credstash_controller_events_already_processed_total",
+    "Events skipped because the Secret already has a newer resourceVersion",
+)
+EVENTS_COALESCED = Counter(
+    "credstash_controller_events_coalesced_total",
+    "Events merged into an event already waiting in the queue",
+)
+WATCH_RESTARTS = Counter(
+    "credstash_controller_watch_restarts_total",
+    "CredStashSecret watch restarts",
+    ["reason"],
+)
+QUEUE_DEPTH = Gauge(
+    "credstash_controller_queue_depth",
+    "CredStashSecrets waiting to be handled",
+)
+SHARD_MEMBERS = Gauge(
+    "credstash_controller_shard_members",
+    "Controller replicas the namespaces are sharded between",
+)
+THROTTLED = Counter(
+    "credstash_controller_throttled_total",
+    "Calls throttled by AWS or the Kubernetes API server",
+    ["backend"],
+)
+RATE_LIMIT = Gauge(
+    "credstash_controller_rate_limit",
+    "Calls per second currently allowed to each backend",
+    ["backend"],
+)
+DRIFT_REPAIRS = Counter(
+    "credstash_controller_drift_repairs_total",
+    "Managed Secrets changed or deleted by someone else and reconciled",
+    ["reason"],
+)
+REGION_READS = Counter(
+    "credstash_controller_region_reads_total",
+    "Credstash reads by the region that answered and whether they were hedged",
+    ["region", "hedged"],
+)
+CACHE_LOOKUPS = Counter(
+    "credstash_controller_cache_lookups_total",
+    "Lookups in the decrypted secret cache",
+    ["result"],
+)
+
+BATCH_GET_MAX_KEYS = 100
+BATCH_GET_MAX_ATTEMPTS = 8
+BATCH_GET_BACKOFF = 0.05
+
+THROTTLE_ERROR_CODES = {
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+}
+THROTTLE_BACKOFF = 0.5
+THROTTLE_MAX_BACKOFF = 60
+
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 0.2
+
+
+def _map_diff(current, desired):
+    current = current or {}
+    desired = desired or {}
+    changes = {
+        key: value
+        for key, value in desired.items()
+        if current.get(key) != value
+    }
+    # A null in a merge patch removes the key
+    changes.update({key: None for key in current if key not in desired})
+    return changes
+
+
+def merge_patch(current, desired):
+    patch = {}
+    for field in ("annotations", "labels"):
+        changes = _map_diff(
+            getattr(current.metadata, field), getattr(desired.metadata, field)
+        )
+        if changes:
+            patch.setdefault("metadata", {})[field] = changes
+    owners = desired.metadata.owner_references
+    if owners != current.metadata.owner_references:
+        # A list in a merge patch replaces the whole list
+        patch.setdefault("metadata", {})["ownerReferences"] = [
+            {
+                owner.attribute_map[field]: value
+                for field, value in owner.to_dict().items()
+                if value is not None
+            }
+            for owner in owners or []
+        ]
+    data = _map_diff(current.data, desired.data)
+    if data:
+        patch["data"] = data
+    return patch
 
 
 class ResourceTooOldException(Exception):
     pass
 
 
+# Events for the same key are never handed to two workers at the same time.
+# Events for a key that is already waiting are merged into the waiting one,
+# and nothing is handed out until it has waited for the debounce window.
+class WorkQueue:
+    def __init__(self, max_depth=0, debounce=0, merge=None):
+        self.max_depth = max_depth
+        self.debounce = debounce
+        self.merge = merge or (lambda old, new: new)
+        self.coalesced = 0
+        self._cond = threading.Condition()
+        self._ready = []
+        self._pending = {}
+        self._processing = set()
+        self._order = itertools.count()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def put(self, key, item):
+        with self._cond:
+            while key not in self._pending:
+                if not self.max_depth or len(self._pending) < self.max_depth:
+                    due = time.monotonic() + self.debounce
+                    self._pending[key] = (due, item)
+                    if key not in self._processing:
+                        heapq.heappush(
+                            self._ready, (due, next(self._order), key)
+                        )
+                    self._cond.notify_all()
+                    return False
+                self._cond.wait()
+            due, pending = self._pending[key]
+            self._pending[key] = (due, self.merge(pending, item))
+            self.coalesced += 1
+            return True
+
+    def get(self):
+        with self._cond:
+            while True:
+                if not self._ready:
+                    self._cond.wait()
+                    continue
+                due, _, key = self._ready[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._ready)
+                _, item = self._pending.pop(key)
+                self._processing.add(key)
+                self._cond.notify_all()
+                return key, item
+
+    def done(self, key):
+        with self._cond:
+            self._processing.discard(key)
+            if key in self._pending:
+                heapq.heappush(
+                    self._ready,
+                    (self._pending[key][0], next(self._order), key),
+                )
+            self._cond.notify_all()
+
+    def join(self):
+        with self._cond:
+            while self._pending or self._processing:
+                self._cond.wait()
+
+    def wait(self, keys):
+        with self._cond:
+            while any(
+                key in self._pending or key in self._processing
+                for key in keys
+            ):
+                self._cond.wait()
+
+    def requeue(self, key, item, delay):
+        with self._cond:
+            # Anything queued for the key since is newer, so it wins
+            if key in self._pending:
+                return False
+            due = time.monotonic() + delay
+            self._pending[key] = (due, item)
+            if key not in self._processing:
+                heapq.heappush(self._ready, (due, next(self._order), key))
+            self._cond.notify_all()
+            return True
+
+
+# Token bucket whose rate backs off by half when the backend throttles us
+# and creeps back up by a fixed step every second it doesn't.
+class RateLimiter:
+    def __init__(self, rate, min_rate=1, increase=None, decrease=0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.increase = increase or max(rate / 20, 1)
+        self.decrease = decrease
+        self._lock = threading.Lock()
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._increased = self._updated
+        self._decreased = None
+
+    def acquire(self):
+        # A rate of 0 doesn't limit anything
+        if not self.max_rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    max(self.rate, 1),
+                    self._tokens + (now - self._updated) * self.rate,
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            now = time.monotonic()
+            self._increased = now
+            # Callers throttled together are answering the same overload
+            if self._decreased is not None and now - self._decreased < 1:
+                return
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, self.rate)
+            self._decreased = now
+
+    def succeeded(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.rate < self.max_rate and now - self._increased >= 1:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+                self._increased = now
+
+
+# The most recent latencies of a call, to hedge it once it's slower than most
+class LatencyWindow:
+    def __init__(self, size=1000):
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def add(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, fraction):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        i = min(len(latencies) - 1, int(len(latencies) * fraction))
+        return latencies[i]
+
+
+def _throttled(error):
+    # credstash raises its own error for whatever KMS failed with
+    if isinstance(error, credstash.KmsError):
+        error = error.__context__
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        return code in THROTTLE_ERROR_CODES
+    return isinstance(error, ApiException) and error.status == 429
+
+
+# Decrypted values are only ever held here, never logged.
+class SecretCache:
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (
+                not self.ttl or entry[1] > time.monotonic()
+            )
+
+    def __repr__(self):
+        return "<SecretCache {} entries, {} hits, {} misses>".format(
+            len(self), self.hits, self.misses
+        )
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if not self.ttl or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    CACHE_LOOKUPS.labels("hit").inc()
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            CACHE_LOOKUPS.labels("miss").inc()
+            return None
+
+    def put(self, key, value):
+        if not self.max_size:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+# Concurrent calls for the same key share the result of the first one.
+class SingleFlight:
+    def __init__(self):
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._unclaimed = set()
+
+    def do(self, key, fn):
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                if future is None:
+                    self._calls[key] = concurrent.futures.Future()
+                    break
+                self.shared += 1
+            try:
+                return future.result()
+            except concurrent.futures.CancelledError:
+                # The leader gave up before fetching it, try again
+                continue
+        return self.resolve(key, fn)
+
+    def lead(self, keys):
+        with self._lock:
+            led = [key for key in keys if key not in self._calls]
+            for key in led:
+                self._calls[key] = concurrent.futures.Future()
+                self._unclaimed.add(key)
+        return led
+
+    def claim(self, key):
+        with self._lock:
+            if key not in self._unclaimed:
+                return False
+            self._unclaimed.discard(key)
+            return True
+
+    def resolve(self, key, fn):
+        with self._lock:
+            future = self._calls[key]
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result()
+
+    def abandon(self, keys):
+        with self._lock:
+            for key in keys:
+                if key in self._unclaimed:
+                    self._unclaimed.discard(key)
+                    self._calls.pop(key).cancel()
+
+
+def _is_newer(secret_obj, current):
+    try:
+        return int(secret_obj.metadata.resource_version) >= int(
+            current.metadata.resource_version
+        )
+    except (TypeError, ValueError):
+        return True
+
+
+# Local copy of the Secrets the controller manages, kept up to date by
+# CredStashController.watch_secrets.
+class SecretStore:
+    def __init__(self):
+        self.synced = threading.Event()
+        self._lock = threading.Lock()
+        self._secrets = {}
+        self._writing = {}
+
+    def __len__(self):
+        return len(self._secrets)
+
+    def get(self, namespace, name):
+        with self._lock:
+            secret_obj = self._secrets.get((namespace, name))
+        # Reconcilers modify what they read
+        return copy.deepcopy(secret_obj)
+
+    def put(self, secret_obj):
+        key = (secret_obj.metadata.namespace, secret_obj.metadata.name)
+        with self._lock:
+            current = self._secrets.get(key)
+            if current is None or _is_newer(secret_obj, current):
+                self._secrets[key] = secret_obj
+            if (
+                key in self._writing
+                and self._writing[key] == _spec_hash(secret_obj)
+            ):
+                del self._writing[key]
+
+    def expect_write(self, secret_obj):
+        # Our own write can come back on the watch before its reply does
+        key = (secret_obj.metadata.namespace, secret_obj.metadata.name)
+        with self._lock:
+            self._writing[key] = _spec_hash(secret_obj)
+
+    def cancel_write(self, namespace, name):
+        with self._lock:
+            self._writing.pop((namespace, name), None)
+
+    def expected_hash(self, namespace, name):
+        with self._lock:
+            return self._writing.get((namespace, name))
+
+    def annotations(self, namespace, name):
+        with self._lock:
+            secret_obj = self._secrets.get((namespace, name))
+            if secret_obj is None:
+                return None
+            return dict(secret_obj.metadata.annotations or {})
+
+    def delete(self, namespace, name):
+        with self._lock:
+            self._secrets.pop((namespace, name), None)
+
+    def replace(self, secrets):
+        with self._lock:
+            previous = self._secrets
+            self._secrets = {
+                (secret_obj.metadata.namespace, secret_obj.metadata.name): (
+                    secret_obj
+                )
+                for secret_obj in secrets
+            }
+            removed = set(previous) - set(self._secrets)
+        self.synced.set()
+        return removed
+
+
+def _spec_hash(secret_obj):
+    return (secret_obj.metadata.annotations or {}).get("credstash-spec-hash")
+
+
+def _owner_reference(credstash_secret):
+    uid = credstash_secret["metadata"].get("uid")
+    if uid is None:
+        return None
+    return V1OwnerReference(
+        api_version="{}/{}".format(DOMAIN, api_version),
+        kind=KIND,
+        name=credstash_secret["metadata"]["name"],
+        uid=uid,
+        controller=True,
+    )
+
+
+def _owned_by(secret_obj, credstash_secret):
+    uid = credstash_secret["metadata"].get("uid")
+    owners = secret_obj.metadata.owner_references or []
+    return uid is not None and any(owner.uid == uid for owner in owners)
+
+
+def _event_key(metadata):
+    return "{}/{}".format(metadata.get("namespace"), metadata.get("name"))
+
+
+def coalesce_events(queued, new):
+    # A deleted object can't be modified, whatever is left is stale
+    if queued[0]["type"] == "DELETED" and new[0]["type"] == "MODIFIED":
+        return queued
+    return new
+
+
+def _ring_hash(value):
+    return int(hashlib.sha256(value.encode()).hexdigest()[:16], 16)
+
+
+# Consistent hashing, so a replica joining or leaving only moves the
+# namespaces it takes over or gives up.
+class HashRing:
+    def __init__(self, members, vnodes=100):
+        self.members = sorted(members)
+        self._ring = sorted(
+            (_ring_hash("{}#{}".format(member, i)), member)
+            for member in self.members
+            for i in range(vnodes)
+        )
+        self._hashes = [point for point, _ in self._ring]
+
+    def owner(self, key):
+        if not self._ring:
+            return None
+        i = bisect.bisect(self._hashes, _ring_hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+
+def _parse_micro_time(value):
+    for time_format in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError("Unknown time format {}".format(value))
+
+
 class CredStashController:
     def __init__(
         self,
@@ -23,6 +602,22 @@ class CredStashController:
         default_region,
         default_table,
         namespaces,
+        fetch_workers=8,
+        workers=4,
+        queue_depth=1000,
+        debounce=0,
+        cache_size=1024,
+        cache_ttl=3600,
+        latest_poll_interval=60,
+        latest_poll_workers=4,
+        shard_identity=None,
+        lease_namespace="kube-system",
+        lease_duration=15,
+        rate_limits=None,
+        drift_repair=True,
+        fallback_regions=None,
+        hedge_delay=None,
+        hedge_timeout=5,
     ):
 
         self.access_key_id = access_key_id
@@ -33,6 +628,84 @@ class CredStashController:
             self.namespaces = namespaces.split(",")
         else:
             self.namespaces = None
+        self.fetch_workers = fetch_workers
+        self.fetch_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=fetch_workers
+        )
+        # Batched keys are decrypted here, never by a thread that may be
+        # waiting on another update's batch
+        self.decrypt_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=fetch_workers
+        )
+        self.workers = workers
+        self.queue = WorkQueue(queue_depth, debounce, coalesce_events)
+        QUEUE_DEPTH.set_function(lambda: len(self.queue))
+        self.worker_threads = []
+        self.cache = SecretCache(cache_size, cache_ttl)
+        self.in_flight = SingleFlight()
+        self._aws_lock = threading.RLock()
+        self._aws_session = None
+        self._aws_clients = {}
+        self._aws_resources = threading.local()
+        self.secrets = SecretStore()
+        self.secret_watch_thread = None
+        self.latest_poll_interval = latest_poll_interval
+        self.latest_poll_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=latest_poll_workers
+        )
+        self.latest_poll_thread = None
+        self._latest_lock = threading.Lock()
+        self._latest_versions = {}
+        self._latest_refs = {}
+        self.shard_identity = shard_identity
+        self.lease_namespace = lease_namespace
+        self.lease_duration = lease_duration
+        self.lease_expires = None
+        self.ring = None
+        self.shard_thread = None
+        self.resync_thread = None
+        self._resync_lock = threading.Lock()
+        self._resync_requested = False
+        rate_limits = dict(
+            {"dynamodb": 100, "kms": 100, "kubernetes": 50},
+            **(rate_limits or {})
+        )
+        self.limiters = {}
+        for backend, rate in rate_limits.items():
+            self.limiters[backend] = RateLimiter(rate)
+            RATE_LIMIT.labels(backend).set_function(
+                lambda limiter=self.limiters[backend]: limiter.rate
+            )
+        self._throttle_attempts = {}
+        self.drift_repair = drift_repair
+        self.regions = [default_region] + [
+            region
+            for region in fallback_regions or []
+            if region != default_region
+        ]
+        self.hedge_delay = hedge_delay
+        # A batch of 100 keys is slower than a single GetItem, so each kind
+        # of read is hedged on its own latencies
+        self.read_latencies = {
+            call: LatencyWindow()
+            for call in ("batch_get_item", "decrypt", "get_secret", "query")
+        }
+        self.reads = 0
+        self.hedged_reads = 0
+        self.hedge_timeout = hedge_timeout
+        self.region_pools = {}
+        if len(self.regions) > 1:
+            # Reads stuck in a slow region only fill that region's pool, so
+            # hedges to the others still get a thread. Every fetch, decrypt,
+            # reconcile and poll thread can be reading at once.
+            self.region_pools = {
+                region: concurrent.futures.ThreadPoolExecutor(
+                    max_workers=2 * fetch_workers
+                    + workers
+                    + latest_poll_workers
+                )
+                for region in self.regions
+            }
 
     def _init_client(self):
         if "KUBERNETES_PORT" in os.environ:
@@ -56,31 +729,798 @@ class CredStashController:
                     "credstash-resourceversion"
                 ] = str(resource_version)
 
-    def update_secret(self, credstash_secret, resource_version):
+    def secret_key(self, secret_to_process):
+        table = self.default_table
+        if "table" in secret_to_process:
+            table = secret_to_process["table"]
+        return (
+            table,
+            secret_to_process["from"],
+            secret_to_process["version"],
+        )
+
+    def aws_session(self):
+        with self._aws_lock:
+            if self._aws_session is None:
+                self._aws_session = boto3.session.Session(
+                    aws_access_key_id=self.access_key_id,
+                    aws_secret_access_key=self.secret_access_key,
+                )
+                # Clients copy these when they're created
+                for service in ("dynamodb", "kms"):
+                    self._aws_session.events.register(
+                        "before-call." + service, self.before_aws_call
+                    )
+                    self._aws_session.events.register(
+                        "after-call." + service, self.after_aws_call
+                    )
+            return self._aws_session
+
+    def before_aws_call(self, model, **kwargs):
+        self.limiters[model.service_model.service_name].acquire()
+
+    def after_aws_call(self, model, parsed, **kwargs):
+        service = model.service_model.service_name
+        if parsed.get("Error", {}).get("Code") in THROTTLE_ERROR_CODES:
+            THROTTLED.labels(service).inc()
+            self.limiters[service].throttled()
+        else:
+            self.limiters[service].succeeded()
+
+    @contextlib.contextmanager
+    def secret_api(self, call):
+        limiter = self.limiters["kubernetes"]
+        limiter.acquire()
+        try:
+            with SECRET_API_SECONDS.labels(call).time():
+                yield
+        except ApiException as e:
+            if e.status == 429:
+                THROTTLED.labels("kubernetes").inc()
+                limiter.throttled()
+            raise
+        limiter.succeeded()
+
+    def aws_timeouts(self):
+        if not self.region_pools:
+            return {}
+        # A stuck read holds a region pool thread until it gives up
+        return {
+            "connect_timeout": self.hedge_timeout,
+            "read_timeout": self.hedge_timeout,
+            "retries": {"max_attempts": 1},
+        }
+
+    def aws_client(self, service, region=None):
+        region = region or self.default_region
+        with self._aws_lock:
+            if (service, region) not in self._aws_clients:
+                # Every fetch and reconcile thread can hold a connection
+                aws_config = Config(
+                    max_pool_connections=self.fetch_workers + self.workers,
+                    tcp_keepalive=True,
+                    **self.aws_timeouts()
+                )
+                self._aws_clients[service, region] = self.aws_session().client(
+                    service, region_name=region, config=aws_config
+                )
+            return self._aws_clients[service, region]
+
+    def aws_resource(self, service, region=None):
+        # boto3 resources aren't thread safe, so each thread gets its own
+        region = region or self.default_region
+        resources = getattr(self._aws_resources, "connections", None)
+        if resources is None:
+            resources = self._aws_resources.connections = {}
+        if (service, region) not in resources:
+            with self._aws_lock:
+                resources[service, region] = self.aws_session().resource(
+                    service,
+                    region_name=region,
+                    config=Config(tcp_keepalive=True, **self.aws_timeouts()),
+                )
+        return resources[service, region]
+
+    def hedge_threshold(self, call):
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        latencies = self.read_latencies[call]
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return latencies.percentile(HEDGE_PERCENTILE)
+
+    def read(self, call, fn):
+        # fn reads from the region it's given, the first answer wins
+        if not self.region_pools:
+            REGION_READS.labels(self.default_region, "false").inc()
+            return fn(self.default_region)
+        started = time.monotonic()
+        unsent = collections.deque(self.regions)
+        pending = {}
+        errors = []
+
+        def send():
+            region = unsent.popleft()
+            pending[self.region_pools[region].submit(fn, region)] = region
+
+        def record_primary(future):
+            if not future.cancelled() and future.exception() is None:
+                self.read_latencies[call].add(time.monotonic() - started)
+
+        send()
+        next(iter(pending)).add_done_callback(record_primary)
+        delay = self.hedge_threshold(call)
+        # Only a read sent because the others were slow counts as a hedge,
+        # not one sent because they failed
+        hedged = False
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending,
+                timeout=delay if unsent else None,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            if not done:
+                print(
+                    "Credstash read took over {:.3f}s, hedging to {}".format(
+                        delay, unsent[0]
+                    )
+                )
+                send()
+                hedged = True
+                continue
+            for future in done:
+                region = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                self.count_read(region, hedged)
+                # The slower reads are left to finish on their own
+                for other in pending:
+                    other.cancel()
+                return result
+            # A failed read is retried in the next region straight away
+            if not pending and unsent:
+                send()
+        raise errors[0]
+
+    def count_read(self, region, hedged):
+        REGION_READS.labels(region, str(hedged).lower()).inc()
+        with self._aws_lock:
+            self.reads += 1
+            if not hedged:
+                return
+            self.hedged_reads += 1
+        print(
+            "Hedged {} of {} credstash reads".format(
+                self.hedged_reads, self.reads
+            )
+        )
+
+    def batch_get_items(self, table, keys):
+        items = dict.fromkeys(keys)
+        for i in range(0, len(keys), BATCH_GET_MAX_KEYS):
+            request = {
+                table: {
+                    "Keys": [
+                        {"name": name, "version": version}
+                        for name, version in keys[i : i + BATCH_GET_MAX_KEYS]
+                    ]
+                }
+            }
+            for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+                if attempt:
+                    time.sleep(
+                        min(BATCH_GET_BACKOFF * 2 ** attempt, 5)
+                        * random.uniform(0.5, 1)
+                    )
+                with CREDSTASH_SECONDS.labels("batch_get_item").time():
+                    response = self.read(
+                        "batch_get_item",
+                        lambda region, request=request: self.aws_resource(
+                            "dynamodb", region
+                        ).batch_get_item(RequestItems=request)
+                    )
+                for item in response["Responses"].get(table, []):
+                    items[(item["name"], item["version"])] = item
+                request = response.get("UnprocessedKeys")
+                if not request:
+                    break
+                # DynamoDB leaves keys unprocessed when it's out of capacity
+                THROTTLED.labels("dynamodb").inc()
+                self.limiters["dynamodb"].throttled()
+            else:
+                # Whatever is still unprocessed gets fetched one at a time
+                for key in request[table]["Keys"]:
+                    del items[(key["name"], key["version"])]
+        return items
+
+    def prefetch_materials(self, spec):
+        missing = collections.defaultdict(list)
+        for secret_to_process in spec:
+            try:
+                table, key, version = self.secret_key(secret_to_process)
+            except (KeyError, TypeError):
+                continue
+            if (table, key, version) not in self.cache:
+                missing[table].append((key, version))
+
+        materials = {}
+        # Every table's keys, a failed batch must release them all
+        led_keys = []
+        try:
+            for table, keys in missing.items():
+                keys = list(dict.fromkeys(keys))
+                # A single key is just as cheap with a GetItem
+                if len(keys) < 2:
+                    continue
+                # Keys another update is already fetching are waited for
+                led = self.in_flight.lead([(table,) + key for key in keys])
+                led_keys.extend(led)
+                if not led:
+                    continue
+                items = self.batch_get_items(
+                    table, [(key, version) for _, key, version in led]
+                )
+                for table_key in led:
+                    if table_key[1:] in items:
+                        materials[table_key] = items[table_key[1:]]
+                    else:
+                        self.in_flight.abandon([table_key])
+        except Exception:
+            self.in_flight.abandon(led_keys)
+            raise
+        return materials
+
+    def resolve_materials(self, materials):
+        resolved = {}
+        for table_key in materials:
+            if self.in_flight.claim(table_key):
+                resolved[table_key] = self.decrypt_pool.submit(
+                    self.in_flight.resolve,
+                    table_key,
+                    lambda table_key=table_key: self.get_secret(
+                        *table_key, materials=materials
+                    ),
+                )
+        return resolved
+
+    def prefetch_secrets(self, spec):
+        # Other updates sharing these keys wait on them from fetch pool
+        # threads, so they're resolved without needing one
+        materials = self.prefetch_materials(spec)
+        try:
+            return self.resolve_materials(materials)
+        finally:
+            self.in_flight.abandon(materials)
+
+    def submit_fetch(self, secret_to_process, resolved):
+        try:
+            cache_key = self.secret_key(secret_to_process)
+        except (KeyError, TypeError):
+            cache_key = None
+        if cache_key in resolved:
+            return resolved[cache_key]
+        return self.fetch_pool.submit(self.fetch_secret, secret_to_process)
+
+    def fetch_secret(self, secret_to_process):
+        cache_key = self.secret_key(secret_to_process)
+        raw_secret = self.cache.get(cache_key)
+        if raw_secret is not None:
+            return raw_secret
+        return self.in_flight.do(
+            cache_key, lambda: self.get_secret(*cache_key)
+        )
+
+    def get_secret(self, table, name, version, materials=None):
+        if materials and (table, name, version) in materials:
+            material = materials[(table, name, version)]
+            if material is None:
+                raise credstash.ItemNotFound(
+                    "Item {{'name': '{}', 'version': '{}'}} couldn't be "
+                    "found.".format(name, version)
+                )
+            with CREDSTASH_SECONDS.labels("decrypt").time():
+                raw_secret = self.read(
+                    "decrypt",
+                    lambda region: credstash.open_aes_ctr_legacy(
+                        credstash.KeyService(
+                            self.aws_client("kms", region), None, {}
+                        ),
+                        material,
+                    )
+                )
+        else:
+            with CREDSTASH_SECONDS.labels("get_secret").time():
+                raw_secret = self.read(
+                    "get_secret",
+                    lambda region: credstash.getSecret(
+                        name=name,
+                        table=table,
+                        version=version,
+                        region=region,
+                        dynamodb=self.aws_resource("dynamodb", region),
+                        kms=self.aws_client("kms", region),
+                    )
+                )
+        self.cache.put((table, name, version), raw_secret)
+        return raw_secret
+
+    def read_secret(self, name, namespace):
+        if self.secrets.synced.is_set():
+            secret_obj = self.secrets.get(namespace, name)
+            if secret_obj is not None:
+                return secret_obj
+        # Not seen by the informer yet, either new or not labelled yet
+        with self.secret_api("read"):
+            return self.v1core.read_namespaced_secret(
+                name, namespace=namespace
+            )
+
+    def remember_secret(self, secret_obj):
+        if self.secrets.synced.is_set():
+            self.secrets.put(secret_obj)
+
+    def watch_secrets(self):
+        while True:
+            try:
+                secret_list = self.v1core.list_secret_for_all_namespaces(
+                    label_selector=MANAGED_LABEL + "=true"
+                )
+                removed = self.secrets.replace(secret_list.items)
+                print(
+                    "Loaded {} managed secrets".format(len(secret_list.items))
+                )
+                # Deleted while we weren't watching
+                for namespace, name in sorted(removed):
+                    self.check_drift(namespace, name, "deleted")
+                stream = watch.Watch().stream(
+                    self.v1core.list_secret_for_all_namespaces,
+                    label_selector=MANAGED_LABEL + "=true",
+                    resource_version=secret_list.metadata.resource_version,
+                )
+                for event in stream:
+                    if event["type"] == "ERROR":
+                        print(
+                            "Secret watch ended - {}, relisting".format(
+                                event["raw_object"].get("message")
+                            )
+                        )
+                        # Read through to the API server until relisted
+                        self.secrets.synced.clear()
+                        break
+                    secret_obj = event["object"]
+                    self.check_drift(
+                        secret_obj.metadata.namespace,
+                        secret_obj.metadata.name,
+                        self.drift_reason(event["type"], secret_obj),
+                    )
+                    if event["type"] == "DELETED":
+                        self.secrets.delete(
+                            secret_obj.metadata.namespace,
+                            secret_obj.metadata.name,
+                        )
+                    else:
+                        self.secrets.put(secret_obj)
+            except Exception:
+                self.secrets.synced.clear()
+                traceback.print_exc()
+                print("ERROR: Secret watch failed, retrying")
+                time.sleep(5)
+
+    def drift_reason(self, operation, secret_obj):
+        known = self.secrets.annotations(
+            secret_obj.metadata.namespace, secret_obj.metadata.name
+        )
+        # Not written by us yet, or we've just deleted it ourselves
+        if known is None:
+            return None
+        if operation == "DELETED":
+            return "deleted"
+        if _spec_hash(secret_obj) not in (
+            known.get("credstash-spec-hash"),
+            self.secrets.expected_hash(
+                secret_obj.metadata.namespace, secret_obj.metadata.name
+            ),
+        ):
+            return "modified"
+        return None
+
+    def check_drift(self, namespace, name, reason):
+        if reason is None or not self.drift_repair:
+            return
+        if self.namespaces is not None and namespace not in self.namespaces:
+            return
+        if not self.owns(namespace):
+            return
+        print(
+            "Managed secret {}/{} was {}, reconciling".format(
+                namespace, name, reason
+            )
+        )
+        DRIFT_REPAIRS.labels(reason).inc()
+        try:
+            self.repair_drift(namespace, name)
+        except Exception:
+            # Don't let one failed read restart the whole watch
+            traceback.print_exc()
+            print("ERROR: Failed to reconcile {}/{}".format(namespace, name))
+
+    def repair_drift(self, namespace, name):
+        self.limiters["kubernetes"].acquire()
+        try:
+            credstash_secret = self.crds.get_namespaced_custom_object(
+                DOMAIN, api_version, namespace, PLURAL, name
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            print(
+                "{}/{} has no CredStashSecret, skipping".format(
+                    namespace, name
+                )
+            )
+            return
+        if not credstash_secret.get("spec"):
+            return
+        # The resourceVersion check would skip it, the CR hasn't changed
+        self.enqueue_event({"type": "MODIFIED", "object": credstash_secret})
+
+    def start_secret_watch(self):
+        if self.secret_watch_thread is None:
+            self.secret_watch_thread = threading.Thread(
+                target=self.watch_secrets, daemon=True
+            )
+            self.secret_watch_thread.start()
+
+    def highest_version(self, table, name):
+        # Only the key is read, the secret itself isn't fetched or decrypted
+        response = self.read(
+            "query",
+            lambda region: self.aws_resource("dynamodb", region)
+            .Table(table)
+            .query(
+                Limit=1,
+                ScanIndexForward=False,
+                ConsistentRead=True,
+                KeyConditionExpression=Key("name").eq(name),
+                ProjectionExpression="version",
+            )
+        )
+        if response["Count"] == 0:
+            raise credstash.ItemNotFound(
+                "Item {{'name': '{}'}} couldn't be found.".format(name)
+            )
+        return response["Items"][0]["version"]
+
+    def resolve_latest(self, credstash_secret):
+        metadata = credstash_secret["metadata"]
+        key = "{}/{}".format(metadata["namespace"], metadata["name"])
+        spec = []
+        refs = set()
+        for secret_to_process in credstash_secret["spec"]:
+            if (
+                not isinstance(secret_to_process, dict)
+                or secret_to_process.get("version", "latest") != "latest"
+                or "from" not in secret_to_process
+            ):
+                spec.append(secret_to_process)
+                continue
+            table = secret_to_process.get("table", self.default_table)
+            ref = (table, secret_to_process["from"])
+            refs.add(ref)
+            with self._latest_lock:
+                version = self._latest_versions.get(ref)
+            if version is None:
+                version = self.highest_version(*ref)
+                with self._latest_lock:
+                    self._latest_versions[ref] = version
+            spec.append(dict(secret_to_process, version=version))
+
+        with self._latest_lock:
+            if refs:
+                self._latest_refs[key] = (credstash_secret, refs)
+            else:
+                self._latest_refs.pop(key, None)
+        return spec
+
+    def untrack_latest(self, credstash_secret):
+        metadata = credstash_secret["metadata"]
+        with self._latest_lock:
+            self._latest_refs.pop(
+                "{}/{}".format(metadata["namespace"], metadata["name"]), None
+            )
+
+    def poll_latest_versions(self):
+        with self._latest_lock:
+            tracked = list(self._latest_refs.values())
+        # Every key is checked once, however many secrets refer to it
+        refs = sorted(set().union(*(refs for _, refs in tracked)))
+
+        def check(ref):
+            try:
+                return ref, self.highest_version(*ref)
+            except (ClientError, credstash.ItemNotFound):
+                traceback.print_exc()
+                return ref, None
+
+        changed = set()
+        for ref, version in self.latest_poll_pool.map(check, refs):
+            if version is None:
+                continue
+            with self._latest_lock:
+                if self._latest_versions.get(ref) != version:
+                    self._latest_versions[ref] = version
+                    changed.add(ref)
+
+        for credstash_secret, refs in tracked:
+            if refs & changed:
+                metadata = credstash_secret["metadata"]
+                print(
+                    "New credstash version for {}/{}, updating".format(
+                        metadata["namespace"], metadata["name"]
+                    )
+                )
+                self.enqueue_event(
+                    {"type": "MODIFIED", "object": credstash_secret}
+                )
+        return changed
+
+    def latest_poll_loop(self):
+        while True:
+            time.sleep(self.latest_poll_interval)
+            try:
+                self.poll_latest_versions()
+            except Exception:
+                traceback.print_exc()
+                print("ERROR: Polling for new credstash versions failed")
+
+    def start_latest_poller(self):
+        if self.latest_poll_thread is None:
+            self.latest_poll_thread = threading.Thread(
+                target=self.latest_poll_loop, daemon=True
+            )
+            self.latest_poll_thread.start()
+
+    def owns(self, namespace):
+        if self.shard_identity is None:
+            return True
+        # Once our lease has run out the others have taken over
+        if self.lease_expires is None or time.monotonic() > self.lease_expires:
+            return False
+        return self.ring.owner(namespace) == self.shard_identity
+
+    def lease_call(self, method, name=None, body=None, query_params=None):
+        # The generated client in use only knows about v1beta1 leases
+        path = LEASE_PATH
+        path_params = {"namespace": self.lease_namespace}
+        if name is not None:
+            path += "/{name}"
+            path_params["name"] = name
+        content_type = "application/json"
+        if method == "PATCH":
+            content_type = "application/merge-patch+json"
+        return self.crds.api_client.call_api(
+            path,
+            method,
+            path_params,
+            query_params or [],
+            {"Accept": "application/json", "Content-Type": content_type},
+            body=body,
+            response_type="object",
+            auth_settings=["BearerToken"],
+            _return_http_data_only=True,
+        )
+
+    def lease_name(self):
+        return "credstash-controller-" + self.shard_identity
+
+    def renew_lease(self):
+        renewed = time.monotonic()
+        name = self.lease_name()
+        spec = {
+            "holderIdentity": self.shard_identity,
+            "leaseDurationSeconds": self.lease_duration,
+            "renewTime": datetime.datetime.utcnow().strftime(
+                "%Y-%m-%dT%H:%M:%S.%fZ"
+            ),
+        }
+        try:
+            self.lease_call("PATCH", name, {"spec": spec})
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            self.lease_call(
+                "POST",
+                body={
+                    "apiVersion": "coordination.k8s.io/v1",
+                    "kind": "Lease",
+                    "metadata": {
+                        "name": name,
+                        "labels": {SHARD_LABEL: "true"},
+                    },
+                    "spec": spec,
+                },
+            )
+        self.lease_expires = renewed + self.lease_duration
+
+    def release_lease(self):
+        if self.shard_identity is None or self.lease_expires is None:
+            return
+        # The others take over now instead of when it would have run out
+        self.lease_expires = None
+        try:
+            self.lease_call("DELETE", self.lease_name())
+        except ApiException as e:
+            if e.status != 404:
+                traceback.print_exc()
+                print("ERROR: Releasing the shard lease failed")
+
+    def prune_lease(self, lease):
+        # Unless it was renewed since we listed it
+        metadata = lease.get("metadata") or {}
+        try:
+            self.lease_call(
+                "DELETE",
+                metadata["name"],
+                {
+                    "preconditions": {
+                        "resourceVersion": metadata["resourceVersion"]
+                    }
+                },
+            )
+        except KeyError:
+            return
+        except ApiException as e:
+            if e.status not in (404, 409):
+                raise
+            return
+        print(
+            "Removed the lease of {}, it ran out".format(
+                lease["spec"]["holderIdentity"]
+            )
+        )
+
+    def shard_members(self):
+        leases = self.lease_call(
+            "GET", query_params=[("labelSelector", SHARD_LABEL + "=true")]
+        )
+        now = datetime.datetime.utcnow()
+        members = {self.shard_identity}
+        for lease in leases["items"]:
+            spec = lease.get("spec") or {}
+            try:
+                expires = _parse_micro_time(
+                    spec["renewTime"]
+                ) + datetime.timedelta(seconds=spec["leaseDurationSeconds"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if expires > now and spec.get("holderIdentity"):
+                members.add(spec["holderIdentity"])
+            # Each pod has its own lease, the ones that are long gone would
+            # otherwise pile up
+            elif expires + datetime.timedelta(
+                seconds=spec["leaseDurationSeconds"]
+            ) < now:
+                self.prune_lease(lease)
+        return sorted(members)
+
+    def update_shard(self):
+        # Events were dropped while it had lapsed
+        lapsed = (
+            self.lease_expires is not None
+            and time.monotonic() > self.lease_expires
+        )
+        self.renew_lease()
+        members = self.shard_members()
+        if self.ring is not None and self.ring.members == members:
+            if lapsed:
+                print("Renewed the shard lease after it lapsed")
+            return lapsed
+        print("Sharding namespaces between {}".format(", ".join(members)))
+        self.ring = HashRing(members)
+        SHARD_MEMBERS.set(len(members))
+        return True
+
+    def shard_loop(self):
+        while True:
+            time.sleep(self.lease_duration / 3)
+            try:
+                if self.update_shard():
+                    self.request_resync()
+            except Exception:
+                traceback.print_exc()
+                print("ERROR: Renewing the shard lease failed")
+
+    def request_resync(self):
+        # Catching up can take much longer than the lease, so it's never
+        # done on the thread that renews it
+        with self._resync_lock:
+            self._resync_requested = True
+            if self.resync_thread is not None:
+                return
+            self.resync_thread = threading.Thread(
+                target=self.resync_loop, daemon=True
+            )
+            self.resync_thread.start()
+
+    def resync_loop(self):
+        while True:
+            with self._resync_lock:
+                if not self._resync_requested:
+                    self.resync_thread = None
+                    return
+                self._resync_requested = False
+            try:
+                # Catch up on the namespaces this replica took over
+                for namespace in self.namespaces or [None]:
+                    self.initial_sync(namespace)
+            except Exception:
+                traceback.print_exc()
+                print("ERROR: Catching up after a shard change failed")
+                time.sleep(WATCH_RETRY_DELAY)
+                with self._resync_lock:
+                    self._resync_requested = True
+
+    def start_sharding(self):
+        if self.shard_identity is None or self.shard_thread is not None:
+            return
+        self.update_shard()
+        self.shard_thread = threading.Thread(
+            target=self.shard_loop, daemon=True
+        )
+        self.shard_thread.start()
+
+    def spec_hash(self, spec):
+        try:
+            resolved = sorted(
+                [secret_to_process["name"]]
+                + list(self.secret_key(secret_to_process))
+                for secret_to_process in spec
+            )
+        except (KeyError, TypeError):
+            return None
+        return hashlib.sha256(json.dumps(resolved).encode()).hexdigest()
+
+    def prepare_update(self, credstash_secret, resource_version):
         try:
             namespace = credstash_secret["metadata"]["namespace"]
             name = credstash_secret["metadata"]["name"]
             spec = credstash_secret["spec"]
         except KeyError:
             print("Missing standard metadata, bailing out!")
-            return
+            return None
 
-        new = True
         try:
-            secret_obj = self.v1core.read_namespaced_secret(
-                name, namespace=namespace
-            )
-            new = False
+            spec = self.resolve_latest(credstash_secret)
+        except ClientError as e:
+            if _throttled(e):
+                raise
+            traceback.print_exc()
+            print("ERROR: Error fetching secret version, bailing out!")
+            return None
+        except credstash.ItemNotFound as e:
+            print("ERROR: {}, bailing out!".format(e))
+            return None
+
+        current = None
+        try:
+            secret_obj = self.read_secret(name, namespace)
+            current = copy.deepcopy(secret_obj)
             try:
                 self.check_resource_version(secret_obj, resource_version)
             except ResourceTooOldException:
                 print("We've already processed this event, skipping")
-                return
+                EVENTS_ALREADY_PROCESSED.inc()
+                return None
         except ApiException as e:
             if e.status != 404:
                 raise
             if resource_version is None:
-                resource_version = -1
+                resource_version = credstash_secret["metadata"].get(
+                    "resourceVersion", -1
+                )
             metadata = V1ObjectMeta(
                 name=name,
                 namespace=namespace,
@@ -88,79 +1528,205 @@ class CredStashController:
                     "credstash-fully-managed": "true",
                     "credstash-resourceversion": str(resource_version),
                 },
+                labels={MANAGED_LABEL: "true"},
             )
+            # The garbage collector deletes it along with its CredStashSecret
+            owner = _owner_reference(credstash_secret)
+            if owner is not None:
+                metadata.owner_references = [owner]
             secret_obj = client.V1Secret(api_version, {}, "Secret", metadata)
 
+        spec_hash = self.spec_hash(spec)
+        if current is not None:
+            self.adopt_secret(secret_obj, credstash_secret)
+            if (
+                spec_hash is not None
+                and secret_obj.metadata.annotations.get("credstash-spec-hash")
+                == spec_hash
+                and secret_obj.metadata.owner_references
+                == current.metadata.owner_references
+            ):
+                print(
+                    "Secret {}/{} is already up to date, skipping".format(
+                        namespace, name
+                    )
+                )
+                return None
+            if secret_obj.metadata.labels is None:
+                secret_obj.metadata.labels = {}
+            secret_obj.metadata.labels[MANAGED_LABEL] = "true"
+        if spec_hash is not None:
+            secret_obj.metadata.annotations["credstash-spec-hash"] = spec_hash
+
         if (
-            new
+            current is None
             or secret_obj.metadata.annotations.get(
                 "credstash-fully-managed", None
             )
             == "true"
+            or secret_obj.data is None
         ):
             secret_obj.data = {}
-        for secret_to_process in spec:
-            try:
-                table = self.default_table
-                if "table" in secret_to_process:
-                    table = secret_to_process["table"]
-                raw_secret = credstash.getSecret(
-                    name=secret_to_process["from"],
-                    table=table,
-                    version=secret_to_process["version"],
-                    aws_access_key_id=self.access_key_id,
-                    aws_secret_access_key=self.secret_access_key,
-                    region=self.default_region,
-                )
-                secret_obj.data[secret_to_process["name"]] = base64.b64encode(
-                    raw_secret.encode()
-                ).decode()
-            except ClientError:
-                traceback.print_exc()
-                print("ERROR: Error fetching secret, bailing out!")
-                return
-            except credstash.ItemNotFound:
-                print(
-                    "ERROR: {} version {} not found, bailing out!".format(
-                        secret_to_process["from"], secret_to_process["version"]
-                    )
+        return namespace, name, spec, secret_obj, current
+
+    def adopt_secret(self, secret_obj, credstash_secret):
+        # A recreated CredStashSecret has a new uid, the garbage collector
+        # would delete a fully managed secret still owned by the old one
+        owner = _owner_reference(credstash_secret)
+        if (
+            owner is None
+            or secret_obj.metadata.annotations.get("credstash-fully-managed")
+            != "true"
+        ):
+            return
+        # Kept in place, so an owner that's already right isn't patched
+        owners = []
+        for existing in secret_obj.metadata.owner_references or []:
+            if existing.kind != KIND:
+                owners.append(existing)
+            elif owner not in owners:
+                owners.append(owner)
+        if owner not in owners:
+            owners.append(owner)
+        secret_obj.metadata.owner_references = owners
+
+    def fetch_failed(self, secret_to_process, error):
+        if isinstance(error, ClientError):
+            traceback.print_exc()
+            print("ERROR: Error fetching secret, bailing out!")
+        elif isinstance(error, credstash.ItemNotFound):
+            print(
+                "ERROR: {} version {} not found, bailing out!".format(
+                    secret_to_process["from"],
+                    secret_to_process["version"],
                 )
-                return
-            except KeyError as e:
-                print(
-                    "{} is missing for this secret, bailing out!".format(
-                        e.args[0]
-                    )
+            )
+        else:
+            print(
+                "{} is missing for this secret, bailing out!".format(
+                    error.args[0]
                 )
-                return
+            )
 
-        if new:
+    def write_secret(self, namespace, name, secret_obj, current):
+        if current is None:
             print(
                 "Creating new secret {}/{} with {} items".format(
                     namespace, name, len(secret_obj.data)
                 )
             )
+            self.secrets.expect_write(secret_obj)
             try:
-                self.v1core.create_namespaced_secret(namespace, secret_obj)
+                with self.secret_api("create"):
+                    secret_obj = self.v1core.create_namespaced_secret(
+                        namespace, secret_obj
+                    )
+                self.remember_secret(secret_obj)
             except ApiException as e:
+                self.secrets.cancel_write(namespace, name)
+                if _throttled(e):
+                    raise
                 print("Problem creating this secret - {}".format(e))
                 return
 
         else:
+            # Only what changed is sent, keys that are no longer wanted
+            # in a fully managed secret are removed
+            patch = merge_patch(current, secret_obj)
+            if not patch:
+                print("Secret {}/{} hasn't changed".format(namespace, name))
+                return
             print(
-                "Updating secret {}/{} with {} items".format(
-                    namespace, name, len(secret_obj.data)
+                "Updating secret {}/{} with {} items, {} changed".format(
+                    namespace,
+                    name,
+                    len(secret_obj.data),
+                    len(patch.get("data", {})),
                 )
             )
+            self.secrets.expect_write(secret_obj)
             try:
-                self.v1core.patch_namespaced_secret(
-                    name, namespace, secret_obj
-                )
+                with self.secret_api("patch"):
+                    secret_obj = self.v1core.patch_namespaced_secret(
+                        name, namespace, patch
+                    )
+                self.remember_secret(secret_obj)
             except ApiException as e:
+                self.secrets.cancel_write(namespace, name)
+                if _throttled(e):
+                    raise
                 print("Problem updating this secret - {}".format(e))
                 return
 
-    def process_event(self, event, resource_version=None):
+    def update_steps(self, credstash_secret, resource_version):
+        # Both engines reconcile with these steps. Each blocking call is
+        # yielded as a function and each fetch as its future, for the engine
+        # to make or wait for its own way and send back the result, or throw
+        # in the error.
+        update = yield lambda: self.prepare_update(
+            credstash_secret, resource_version
+        )
+        if update is None:
+            return
+        namespace, name, spec, secret_obj, current = update
+
+        try:
+            resolved = yield lambda: self.prefetch_secrets(spec)
+        except ClientError as e:
+            if _throttled(e):
+                raise
+            traceback.print_exc()
+            print("ERROR: Error fetching secret, bailing out!")
+            return
+        futures = [
+            self.submit_fetch(secret_to_process, resolved)
+            for secret_to_process in spec
+        ]
+        try:
+            for secret_to_process, future in zip(spec, futures):
+                try:
+                    raw_secret = yield future
+                    secret_obj.data[
+                        secret_to_process["name"]
+                    ] = base64.b64encode(raw_secret.encode()).decode()
+                except (ClientError, credstash.ItemNotFound, KeyError) as e:
+                    if _throttled(e):
+                        raise
+                    self.fetch_failed(secret_to_process, e)
+                    return
+        finally:
+            # Don't leave the rest of an abandoned update queued up, but
+            # others may be waiting on the keys it's decrypting
+            for future in futures:
+                if future not in resolved.values():
+                    future.cancel()
+            print(
+                "Secret cache: {} hits, {} misses".format(
+                    self.cache.hits, self.cache.misses
+                )
+            )
+
+        yield lambda: self.write_secret(namespace, name, secret_obj, current)
+
+    def update_secret(self, credstash_secret, resource_version):
+        steps = self.update_steps(credstash_secret, resource_version)
+        with contextlib.closing(steps):
+            send, value = steps.send, None
+            while True:
+                try:
+                    step = send(value)
+                except StopIteration:
+                    return
+                try:
+                    if isinstance(step, concurrent.futures.Future):
+                        value = step.result()
+                    else:
+                        value = step()
+                    send = steps.send
+                except Exception as e:
+                    send, value = steps.throw, e
+
+    def accept_event(self, event):
         print("Event received. - {}".format(event["type"]))
 
         obj = event["object"]
@@ -170,62 +1736,293 @@ class CredStashController:
             raise Exception("Error event received")
         spec = obj.get("spec")
         if not spec:
-            return
+            return None
         namespace = obj["metadata"]["namespace"]
         if self.namespaces is not None and namespace not in self.namespaces:
             print(
                 "Secret requested from an " "unauthorized namespace, skipping."
             )
-            return
+            return None
+        if not self.owns(namespace):
+            print(
+                "{} is handled by another replica, skipping.".format(namespace)
+            )
+            return None
         metadata = obj.get("metadata")
 
         name = metadata["name"]
         print("Handling %s on %s/%s" % (operation, namespace, name))
+        return obj
+
+    def process_event(self, event, resource_version=None):
+        obj = self.accept_event(event)
+        if obj is None:
+            return
+        operation = event["type"]
         if operation in ("ADDED", "MODIFIED"):
             self.update_secret(obj, resource_version)
         if operation == "DELETED":
+            self.untrack_latest(obj)
             self.delete_secret(obj, resource_version)
 
-    def main_loop(self):
+    def enqueue_event(self, event, resource_version=None):
+        key = _event_key(event["object"]["metadata"])
+        if self.queue.put(key, (event, resource_version)):
+            EVENTS_COALESCED.inc()
+            print(
+                "Coalesced {} for {} with a queued event, "
+                "{} coalesced so far".format(
+                    event["type"], key, self.queue.coalesced
+                )
+            )
+
+    def event_failed(self, key, event, resource_version, error):
+        if not _throttled(error):
+            traceback.print_exc()
+            print("ERROR: Failed to process event for {}".format(key))
+            return "error"
+        # Try again later rather than drop it, backing off while throttled
+        attempt = self._throttle_attempts.get(key, 0)
+        self._throttle_attempts[key] = attempt + 1
+        delay = min(
+            THROTTLE_BACKOFF * 2 ** attempt, THROTTLE_MAX_BACKOFF
+        ) * random.uniform(0.5, 1)
+        print("Throttled handling {}, retrying in {:.1f}s".format(key, delay))
+        self.queue.requeue(key, (event, resource_version), delay)
+        return "throttled"
+
+    def worker(self):
         while True:
-            print("Waiting for credstash secrets to be defined...")
-            self._init_client()
-            stream = watch.Watch().stream(
-                self.crds.list_cluster_custom_object,
-                DOMAIN,
-                "v1",
-                "credstashsecrets"
-            )
-
-            for event in stream:
-                obj = event["object"]
-                metadata = obj.get("metadata")
-                spec = obj.get("spec")
-                code = obj.get("code")
-
-                if code == 410:
-                    print("Received HTTP 410, restarting..")
-                    break
+            key, (event, resource_version) = self.queue.get()
+            outcome = "error"
+            try:
+                with EVENT_SECONDS.labels(event["type"]).time():
+                    self.process_event(event, resource_version)
+                outcome = "ok"
+                self._throttle_attempts.pop(key, None)
+            except Exception as e:
+                outcome = self.event_failed(key, event, resource_version, e)
+            finally:
+                EVENTS.labels(event["type"], outcome).inc()
+                self.queue.done(key)
+
+    def start_workers(self):
+        while len(self.worker_threads) < self.workers:
+            thread = threading.Thread(target=self.worker, daemon=True)
+            thread.start()
+            self.worker_threads.append(thread)
 
-                if not metadata or not spec:
+    def _credstash_secrets_path(self, namespace):
+        path_params = {
+            "group": DOMAIN,
+            "version": api_version,
+            "plural": PLURAL,
+        }
+        if namespace is None:
+            return "/apis/{group}/{version}/{plural}", path_params
+        path_params["namespace"] = namespace
+        return (
+            "/apis/{group}/{version}/namespaces/{namespace}/{plural}",
+            path_params,
+        )
+
+    def watch_credstash_secrets(self, resource_version=None, namespace=None):
+        # The generated client in use doesn't know about bookmarks
+        query_params = [("watch", "true"), ("allowWatchBookmarks", "true")]
+        if resource_version is not None:
+            query_params.append(("resourceVersion", resource_version))
+        path, path_params = self._credstash_secrets_path(namespace)
+        response = self.crds.api_client.call_api(
+            path,
+            "GET",
+            path_params,
+            query_params,
+            {"Accept": "application/json"},
+            auth_settings=["BearerToken"],
+            _return_http_data_only=True,
+            _preload_content=False,
+        )
+        try:
+            for line in watch.watch.iter_resp_lines(response):
+                yield json.loads(line)
+        finally:
+            response.close()
+            response.release_conn()
+
+    def list_credstash_secrets(self, namespace=None):
+        query_params = [("limit", LIST_PAGE_SIZE)]
+        path, path_params = self._credstash_secrets_path(namespace)
+        while True:
+            page = self.crds.api_client.call_api(
+                path,
+                "GET",
+                path_params,
+                query_params,
+                {"Accept": "application/json"},
+                response_type="object",
+                auth_settings=["BearerToken"],
+                _return_http_data_only=True,
+            )
+            yield page
+            continue_token = page["metadata"].get("continue")
+            if not continue_token:
+                return
+            query_params = [
+                ("limit", LIST_PAGE_SIZE),
+                ("continue", continue_token),
+            ]
+
+    def is_up_to_date(self, credstash_secret):
+        # The newest version may have changed while nobody was watching
+        if any(
+            isinstance(secret_to_process, dict)
+            and secret_to_process.get("version", "latest") == "latest"
+            for secret_to_process in credstash_secret["spec"]
+        ):
+            return False
+        metadata = credstash_secret["metadata"]
+        secret_obj = self.secrets.get(metadata["namespace"], metadata["name"])
+        if secret_obj is None or not secret_obj.metadata.annotations:
+            return False
+        try:
+            return int(
+                secret_obj.metadata.annotations.get(
+                    "credstash-resourceversion", -1
+                )
+            ) >= int(metadata["resourceVersion"])
+        except ValueError:
+            return False
+
+    def initial_sync(self, namespace=None):
+        started = time.monotonic()
+        if not self.secrets.synced.wait(SECRET_SYNC_TIMEOUT):
+            print("Managed secrets not loaded yet, reconciling everything")
+        total = 0
+        queued = []
+        for page in self.list_credstash_secrets(namespace):
+            for credstash_secret in page["items"]:
+                total += 1
+                if not credstash_secret.get("spec"):
+                    continue
+                if not self.owns(credstash_secret["metadata"]["namespace"]):
                     continue
+                if self.is_up_to_date(credstash_secret):
+                    continue
+                queued.append(_event_key(credstash_secret["metadata"]))
+                self.enqueue_event(
+                    {"type": "ADDED", "object": credstash_secret},
+                    credstash_secret["metadata"]["resourceVersion"],
+                )
+        # Only what this sync queued, other namespaces' events don't hold
+        # up this watch
+        self.wait_for_events(queued)
+        print(
+            "Initial sync of {} credstash secrets{} took {:.2f}s, "
+            "{} were out of date".format(
+                total,
+                "" if namespace is None else " in " + namespace,
+                time.monotonic() - started,
+                len(queued),
+            )
+        )
+        return page["metadata"]["resourceVersion"]
+
+    def wait_for_events(self, keys):
+        self.queue.wait(keys)
+
+    def watch_loop(self, namespace=None):
+        resource_version = None
+        while True:
+            try:
+                if resource_version is None:
+                    print("Syncing existing credstash secrets...")
+                    resource_version = self.initial_sync(namespace)
+                    print(
+                        "Watching for changes from {}".format(
+                            resource_version
+                        )
+                    )
+                else:
+                    print("Resuming watch from {}".format(resource_version))
+                for event in self.watch_credstash_secrets(
+                    resource_version, namespace=namespace
+                ):
+                    obj = event["object"]
+                    if event["type"] == "ERROR":
+                        if obj.get("code") == 410:
+                            print("Received HTTP 410, relisting..")
+                            WATCH_RESTARTS.labels("gone").inc()
+                            resource_version = None
+                        else:
+                            print("Error Received - {}".format(event))
+                            WATCH_RESTARTS.labels("error").inc()
+                            time.sleep(WATCH_RETRY_DELAY)
+                        break
+
+                    metadata = obj.get("metadata")
+                    if metadata and metadata.get("resourceVersion"):
+                        resource_version = metadata["resourceVersion"]
+                    if event["type"] == "BOOKMARK":
+                        continue
+
+                    if not metadata or not obj.get("spec"):
+                        continue
+                    if not self.owns(metadata.get("namespace")):
+                        continue
+
+                    self.enqueue_event(event, resource_version)
+                else:
+                    WATCH_RESTARTS.labels("closed").inc()
+            except ApiException as e:
+                if e.status == 410:
+                    print("Received HTTP 410, relisting..")
+                    WATCH_RESTARTS.labels("gone").inc()
+                    resource_version = None
+                else:
+                    traceback.print_exc()
+                    WATCH_RESTARTS.labels("error").inc()
+                    time.sleep(WATCH_RETRY_DELAY)
+            except Exception:
+                traceback.print_exc()
+                WATCH_RESTARTS.labels("error").inc()
+                time.sleep(WATCH_RETRY_DELAY)
 
-                if metadata["resourceVersion"] is not None:
-                    resource_version = metadata["resourceVersion"]
+    def main_loop(self):
+        self.start_workers()
+        self._init_client()
+        self.start_secret_watch()
+        self.start_sharding()
+        self.start_latest_poller()
+        try:
+            if self.namespaces is None:
+                self.watch_loop()
+                return
 
-                self.process_event(event, resource_version)
+            # Only ask the API server for the namespaces we're allowed to
+            # serve
+            threads = [
+                threading.Thread(
+                    target=self.watch_loop, args=(namespace,), daemon=True
+                )
+                for namespace in self.namespaces
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.release_lease()
 
     def delete_secret(self, credstash_secret, resource_version):
         namespace = credstash_secret["metadata"]["namespace"]
         name = credstash_secret["metadata"]["name"]
         try:
-            secret_obj = self.v1core.read_namespaced_secret(
-                name, namespace=namespace
-            )
+            secret_obj = self.read_secret(name, namespace)
             try:
                 self.check_resource_version(secret_obj, resource_version)
             except ResourceTooOldException:
                 print("We've already processed this event, skipping")
+                EVENTS_ALREADY_PROCESSED.inc()
                 return
         except ApiException as e:
             if e.status != 404:
@@ -234,6 +2031,14 @@ class CredStashController:
                 "Secret already deleted, returning"
                 return
 
+        if _owned_by(secret_obj, credstash_secret):
+            print(
+                "{} is owned by its CredStashSecret, leaving it to the "
+                "garbage collector".format(name)
+            )
+            # Its deletion isn't drift
+            self.secrets.delete(namespace, name)
+            return
         if (
             secret_obj.metadata.annotations.get(
                 "credstash-fully-managed", None
@@ -241,17 +2046,258 @@ class CredStashController:
             == "true"
         ):
             print("{} is managed by credstash, deleting it".format(name))
-            self.v1core.delete_namespaced_secret(
-                name, namespace, V1DeleteOptions()
-            )
+            with self.secret_api("delete"):
+                self.v1core.delete_namespaced_secret(
+                    name, namespace, V1DeleteOptions()
+                )
+            self.secrets.delete(namespace, name)
         else:
             print(
                 "{} is NOT managed by credstash, NOT deleting it".format(name)
             )
 
 
-if __name__ == "__main__":
+# Reconciles are coroutines on one event loop, so thousands can be waiting
+# on AWS or the API server at once without a thread each. The credstash and
+# kubernetes clients only block, so their calls are run on a pool of their
+# own, and fetches aren't queued up behind them.
+class AsyncCredStashController(CredStashController):
+    def __init__(self, *args, concurrency=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # More threads would only be waiting for one of the AWS client's
+        # connections, and more events for one of the threads
+        call_workers = self.fetch_workers + self.workers
+        self.call_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=call_workers
+        )
+        self.concurrency = concurrency or call_workers
+        self.loop = None
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+
+    async def call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.call_pool, fn, *args
+        )
+
+    async def update_secret_async(self, credstash_secret, resource_version):
+        steps = self.update_steps(credstash_secret, resource_version)
+        with contextlib.closing(steps):
+            send, value = steps.send, None
+            while True:
+                try:
+                    step = send(value)
+                except StopIteration:
+                    return
+                try:
+                    if isinstance(step, concurrent.futures.Future):
+                        value = await asyncio.wrap_future(step)
+                    else:
+                        value = await self.call(step)
+                    send = steps.send
+                except Exception as e:
+                    send, value = steps.throw, e
+
+    async def delete_secret_async(self, credstash_secret, resource_version):
+        await self.call(self.delete_secret, credstash_secret, resource_version)
+
+    async def process_event_async(self, event, resource_version=None):
+        obj = self.accept_event(event)
+        if obj is None:
+            return
+        operation = event["type"]
+        if operation in ("ADDED", "MODIFIED"):
+            await self.update_secret_async(obj, resource_version)
+        if operation == "DELETED":
+            self.untrack_latest(obj)
+            await self.delete_secret_async(obj, resource_version)
+
+    # Blocking entry points, so both engines can be driven the same way
+    def update_secret(self, credstash_secret, resource_version):
+        asyncio.run(
+            self.update_secret_async(credstash_secret, resource_version)
+        )
 
+    def process_event(self, event, resource_version=None):
+        asyncio.run(self.process_event_async(event, resource_version))
+
+    async def handle_event(self, key, event, resource_version):
+        outcome = "error"
+        try:
+            with EVENT_SECONDS.labels(event["type"]).time():
+                await self.process_event_async(event, resource_version)
+            outcome = "ok"
+            self._throttle_attempts.pop(key, None)
+        except Exception as e:
+            outcome = self.event_failed(key, event, resource_version, e)
+        finally:
+            EVENTS.labels(event["type"], outcome).inc()
+            self.queue.done(key)
+            self._slots.release()
+
+    def dispatch_events(self):
+        while True:
+            # The queue still keeps events for one secret in order
+            self._slots.acquire()
+            key, (event, resource_version) = self.queue.get()
+            asyncio.run_coroutine_threadsafe(
+                self.handle_event(key, event, resource_version), self.loop
+            )
+
+    def start_workers(self):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            for target in (self.loop.run_forever, self.dispatch_events):
+                thread = threading.Thread(target=target, daemon=True)
+                thread.start()
+                self.worker_threads.append(thread)
+
+
+# Sent after the events a sync queued, acknowledged once they're handled
+SyncBarrier = collections.namedtuple("SyncBarrier", ["token", "keys"])
+
+
+def acknowledge(controller, barrier, acks):
+    controller.queue.wait(barrier.keys)
+    acks.put(barrier.token)
+
+
+def process_worker(engine, args, kwargs, events, acks):
+    controller = engine(*args, **kwargs)
+    controller.start_workers()
+    # The supervisor watches managed secrets, a cluster-wide watch in every
+    # worker would only add to the API server's load
+    controller._init_client()
+    controller.start_latest_poller()
+    while True:
+        queued = events.get()
+        if queued is None:
+            return controller
+        if isinstance(queued, SyncBarrier):
+            threading.Thread(
+                target=acknowledge,
+                args=(controller, queued, acks),
+                daemon=True,
+            ).start()
+            continue
+        controller.enqueue_event(*queued)
+
+
+# The supervisor watches CredStashSecrets and hands every event to one of the
+# worker processes, always the same one for the same secret so they're still
+# handled in order. Each worker is a whole controller with its own clients,
+# so decoding and decrypting isn't limited to one core by the GIL.
+class MultiProcessController(CredStashController):
+    def __init__(
+        self,
+        *args,
+        processes=2,
+        engine=CredStashController,
+        engine_options=None,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.processes = processes
+        self.engine = engine
+        # The limits are shared out between the workers
+        rate_limits = {
+            backend: limiter.max_rate / processes
+            for backend, limiter in self.limiters.items()
+        }
+        self.worker_args = args
+        self.worker_kwargs = dict(
+            kwargs,
+            rate_limits=rate_limits,
+            # Sharding between replicas is done here, before handing out
+            shard_identity=None,
+            # and so is drift repair, or every worker would repair it
+            drift_repair=False,
+            **(engine_options or {})
+        )
+        self.context = multiprocessing.get_context("spawn")
+        self.event_queues = []
+        self.worker_processes = []
+        self.acks = None
+        self._acked = set()
+        self._acked_cond = threading.Condition()
+        self._barriers = itertools.count()
+
+    def start_process(self, index):
+        process = self.context.Process(
+            target=process_worker,
+            args=(
+                self.engine,
+                self.worker_args,
+                self.worker_kwargs,
+                self.event_queues[index],
+                self.acks,
+            ),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def start_workers(self):
+        if self.acks is None:
+            self.acks = self.context.Queue()
+            thread = threading.Thread(target=self.receive_acks, daemon=True)
+            thread.start()
+            self.worker_threads.append(thread)
+        while len(self.worker_processes) < self.processes:
+            self.event_queues.append(
+                self.context.Queue(self.queue.max_depth or 0)
+            )
+            self.worker_processes.append(
+                self.start_process(len(self.worker_processes))
+            )
+
+    def receive_acks(self):
+        while True:
+            token = self.acks.get()
+            with self._acked_cond:
+                self._acked.add(token)
+                self._acked_cond.notify_all()
+
+    def worker_for(self, key):
+        index = _ring_hash(key) % self.processes
+        if not self.worker_processes[index].is_alive():
+            # What it hadn't taken off its queue yet is still there
+            print(
+                "Worker process {} exited with {}, restarting it".format(
+                    index, self.worker_processes[index].exitcode
+                )
+            )
+            self.worker_processes[index] = self.start_process(index)
+        return index
+
+    def enqueue_event(self, event, resource_version=None):
+        index = self.worker_for(_event_key(event["object"]["metadata"]))
+        self.event_queues[index].put((event, resource_version))
+
+    def wait_for_events(self, keys):
+        # The events were handed to the workers, they say when they're done
+        by_worker = collections.defaultdict(list)
+        for key in keys:
+            by_worker[_ring_hash(key) % self.processes].append(key)
+        waiting = {}
+        for index, worker_keys in by_worker.items():
+            token = next(self._barriers)
+            self.event_queues[index].put(SyncBarrier(token, worker_keys))
+            waiting[token] = worker_keys[0]
+        with self._acked_cond:
+            while waiting:
+                for token in list(waiting):
+                    if token in self._acked:
+                        self._acked.discard(token)
+                        del waiting[token]
+                if not waiting:
+                    return
+                self._acked_cond.wait(WATCH_RETRY_DELAY)
+                # One that exited would never answer
+                for key in waiting.values():
+                    self.worker_for(key)
+
+
+def main():
     main_access_key_id = os.environ["CREDSTASH_AWS_ACCESS_KEY_ID"]
     main_secret_access_key = os.environ["CREDSTASH_AWS_SECRET_ACCESS_KEY"]
     main_default_region = os.environ["CREDSTASH_AWS_DEFAULT_REGION"]
@@ -259,13 +2305,97 @@ if __name__ == "__main__":
         "CREDSTASH_DEFAULT_TABLE", "credential-store"
     )
     main_namespaces = os.environ.get("namespaces", "*")
+    main_engine = os.environ.get("CREDSTASH_ENGINE", "threads")
+    main_processes = int(os.environ.get("CREDSTASH_PROCESSES", 1))
+    main_metrics_port = int(os.environ.get("CREDSTASH_METRICS_PORT", 9090))
+    main_fetch_workers = int(os.environ.get("CREDSTASH_FETCH_WORKERS", 8))
+    main_workers = int(os.environ.get("CREDSTASH_WORKERS", 4))
+    main_queue_depth = int(os.environ.get("CREDSTASH_QUEUE_DEPTH", 1000))
+    main_debounce = float(os.environ.get("CREDSTASH_DEBOUNCE_SECONDS", 0))
+    main_cache_size = int(os.environ.get("CREDSTASH_CACHE_SIZE", 1024))
+    main_cache_ttl = int(os.environ.get("CREDSTASH_CACHE_TTL", 3600))
+    main_latest_poll_interval = int(
+        os.environ.get("CREDSTASH_LATEST_POLL_SECONDS", 60)
+    )
+    main_latest_poll_workers = int(
+        os.environ.get("CREDSTASH_LATEST_POLL_WORKERS", 4)
+    )
+    main_shard_identity = os.environ.get("CREDSTASH_SHARD_IDENTITY") or None
+    main_lease_namespace = os.environ.get(
+        "CREDSTASH_LEASE_NAMESPACE", "kube-system"
+    )
+    main_lease_duration = int(os.environ.get("CREDSTASH_LEASE_SECONDS", 15))
+    main_fallback_regions = [
+        region
+        for region in os.environ.get(
+            "CREDSTASH_FALLBACK_REGIONS", ""
+        ).split(",")
+        if region
+    ]
+    main_hedge_delay = os.environ.get("CREDSTASH_HEDGE_SECONDS") or None
+    if main_hedge_delay is not None:
+        main_hedge_delay = float(main_hedge_delay)
+    main_hedge_timeout = float(
+        os.environ.get("CREDSTASH_HEDGE_TIMEOUT_SECONDS", 5)
+    )
+    main_rate_limits = {
+        "dynamodb": float(os.environ.get("CREDSTASH_DYNAMODB_RATE", 100)),
+        "kms": float(os.environ.get("CREDSTASH_KMS_RATE", 100)),
+        "kubernetes": float(os.environ.get("CREDSTASH_KUBERNETES_RATE", 50)),
+    }
 
-    credstash_controller = CredStashController(
+    engine_options = {}
+    if main_engine == "asyncio":
+        engine = AsyncCredStashController
+        engine_options["concurrency"] = int(
+            os.environ.get("CREDSTASH_ASYNC_CONCURRENCY", 0)
+        )
+    elif main_engine == "threads":
+        engine = CredStashController
+    else:
+        raise SystemExit("Unknown CREDSTASH_ENGINE {}".format(main_engine))
+
+    if main_processes > 1:
+        engine_options = {
+            "processes": main_processes,
+            "engine": engine,
+            "engine_options": engine_options,
+        }
+        engine = MultiProcessController
+
+    credstash_controller = engine(
         main_access_key_id,
         main_secret_access_key,
         main_default_region,
         main_default_table,
         main_namespaces,
+        fetch_workers=main_fetch_workers,
+        workers=main_workers,
+        queue_depth=main_queue_depth,
+        debounce=main_debounce,
+        cache_size=main_cache_size,
+        cache_ttl=main_cache_ttl,
+        latest_poll_interval=main_latest_poll_interval,
+        latest_poll_workers=main_latest_poll_workers,
+        shard_identity=main_shard_identity,
+        lease_namespace=main_lease_namespace,
+        lease_duration=main_lease_duration,
+        rate_limits=main_rate_limits,
+        fallback_regions=main_fallback_regions,
+        hedge_delay=main_hedge_delay,
+        hedge_timeout=main_hedge_timeout,
+        **engine_options,
     )
 
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    # Exiting on SIGTERM lets it release its shard lease
+    signal.signal(signal.SIGTERM, stop)
+    if main_metrics_port:
+        start_http_server(main_metrics_port)
     credstash_controller.main_loop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+
+def parse_importtime(output):
+    # Lines look like "import time:  self [us] | cumulative | module", with
+    # the module indented two spaces for each level of nesting. Modules come
+    # after everything they import.
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), self_us, cumulative_us, depth))
+    return modules
+
+
+def direct_imports(modules, module):
+    names = [name for name, _, _, _ in modules]
+    imports = []
+    for name, _, _, depth in reversed(modules[: names.index(module)]):
+        if depth == 0:
+            break
+        if depth == 1:
+            imports.append(name)
+    return imports
+
+
+def measure(module, runs=5):
+    results = []
+    # The first run may have to write the bytecode cache, it isn't counted
+    for run in range(runs + 1):
+        output = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import " + module],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        ).stderr
+        if run:
+            results.append(parse_importtime(output))
+    return results
+
+
+def report(module, results, top=10):
+    by_name = [
+        {name: (self_us, cumulative) for name, self_us, cumulative, _ in run}
+        for run in results
+    ]
+
+    def median_ms(name, field):
+        return (
+            statistics.median(
+                result[name][field] for result in by_name if name in result
+            )
+            / 1000
+        )
+
+    heaviest = sorted(
+        direct_imports(results[0], module),
+        key=lambda name: median_ms(name, 1),
+        reverse=True,
+    )
+    return {
+        "module": module,
+        "runs": len(results),
+        "total_ms": round(median_ms(module, 1), 1),
+        "self_ms": round(median_ms(module, 0), 1),
+        "modules": len(results[0]),
+        "heaviest": [
+            {"module": name, "cumulative_ms": round(median_ms(name, 1), 1)}
+            for name in heaviest[:top]
+        ],
+    }
+
+
+def check(result, target_ms=0, max_modules=0):
+    errors = []
+    if target_ms and result["total_ms"] > target_ms:
+        errors.append(
+            "import {} took {}ms, the target is {}ms".format(
+                result["module"], result["total_ms"], target_ms
+            )
+        )
+    # Unlike the time, this doesn't depend on how fast the machine is
+    if max_modules and result["modules"] > max_modules:
+        errors.append(
+            "import {} loaded {} modules, the most allowed is {}".format(
+                result["module"], result["modules"], max_modules
+            )
+        )
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report how long importing the controller takes"
+    )
+    parser.add_argument("--module", default="controller")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument(
+        "--target-ms",
+        type=float,
+        default=0,
+        help="Exit with an error if the median import takes longer",
+    )
+    parser.add_argument(
+        "--max-modules",
+        type=int,
+        default=0,
+        help="Exit with an error if the import loads more modules",
+    )
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    result = report(
+        args.module, measure(args.module, args.runs), top=args.top
+    )
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print(
+            "import {module}: {total_ms}ms ({self_ms}ms in the module "
+            "itself), {modules} modules, median of {runs} runs".format(
+                **result
+            )
+        )
+        for heavy in result["heaviest"]:
+            print(
+                "{:>10}ms {}".format(heavy["cumulative_ms"], heavy["module"])
+            )
+    errors = check(result, args.target_ms, args.max_modules)
+    for error in errors:
+        print("ERROR: " + error)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+import argparse
+import collections
+import contextlib
+import gzip
+import io
+import json
+import os
+import time
+
+import credstash
+from moto import mock_aws
+
+from benchmark import (
+    ENGINES,
+    REGION,
+    TABLE,
+    FakeCoreV1Api,
+    count_aws_calls,
+    percentile,
+    setup_credstash,
+    time_events,
+)
+from controller import CredStashController
+
+METADATA_FIELDS = ("namespace", "name", "resourceVersion", "uid")
+SPEC_FIELDS = ("name", "from", "version", "table")
+
+
+def redact(obj):
+    # Only what the controller reads is kept, annotations and anything else
+    # in the spec could hold a value
+    metadata = obj.get("metadata") or {}
+    spec = obj.get("spec")
+    if isinstance(spec, list):
+        spec = [
+            {field: entry[field] for field in SPEC_FIELDS if field in entry}
+            if isinstance(entry, dict)
+            else None
+            for entry in spec
+        ]
+    else:
+        spec = None
+    return {
+        "metadata": {
+            field: metadata[field]
+            for field in METADATA_FIELDS
+            if field in metadata
+        },
+        "spec": spec,
+    }
+
+
+def open_recording(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
+
+
+def record(
+    controller, path, namespace=None, duration=None, include_existing=False
+):
+    started = time.monotonic()
+    recorded = 0
+    with open_recording(path, "w") as recording:
+
+        def write(event_type, obj):
+            recording.write(
+                json.dumps(
+                    {
+                        "t": round(time.monotonic() - started, 3),
+                        "type": event_type,
+                        "object": redact(obj),
+                    },
+                    separators=(",", ":"),
+                    sort_keys=True,
+                )
+                + "\n"
+            )
+
+        for page in controller.list_credstash_secrets(namespace):
+            if include_existing:
+                for obj in page["items"]:
+                    write("ADDED", obj)
+                    recorded += 1
+        resource_version = page["metadata"]["resourceVersion"]
+
+        try:
+            while duration is None or time.monotonic() - started < duration:
+                for event in controller.watch_credstash_secrets(
+                    resource_version, namespace=namespace
+                ):
+                    obj = event["object"]
+                    if event["type"] == "ERROR":
+                        print(
+                            "Watch ended - {}, stopping".format(
+                                obj.get("message")
+                            )
+                        )
+                        return recorded
+                    metadata = obj.get("metadata") or {}
+                    resource_version = metadata.get(
+                        "resourceVersion", resource_version
+                    )
+                    if event["type"] != "BOOKMARK":
+                        write(event["type"], obj)
+                        recorded += 1
+                    if (
+                        duration is not None
+                        and time.monotonic() - started >= duration
+                    ):
+                        return recorded
+        except KeyboardInterrupt:
+            pass
+    return recorded
+
+
+def load(path):
+    with open_recording(path, "r") as recording:
+        return [json.loads(line) for line in recording if line.strip()]
+
+
+def stand_in_secrets(events, default_table=TABLE):
+    secrets = set()
+    for event in events:
+        for entry in event["object"].get("spec") or []:
+            if not isinstance(entry, dict) or "from" not in entry:
+                continue
+            version = entry.get("version", "latest")
+            if version == "latest":
+                version = credstash.paddedInt(1)
+            secrets.add(
+                (entry.get("table", default_table), entry["from"], version)
+            )
+    return sorted(secrets)
+
+
+def replay(
+    events,
+    speed=0,
+    workers=4,
+    fetch_workers=8,
+    debounce=0,
+    aws_latency=0,
+    api_latency=0,
+    controller_factory=CredStashController,
+):
+    with mock_aws():
+        setup_credstash(stand_in_secrets(events))
+        controller = controller_factory(
+            "bench",
+            "bench",
+            REGION,
+            TABLE,
+            "*",
+            fetch_workers=fetch_workers,
+            workers=workers,
+            debounce=debounce,
+        )
+        controller.v1core = FakeCoreV1Api(api_latency)
+        aws_calls = count_aws_calls(controller, aws_latency)
+        latencies = time_events(controller)
+        controller.start_workers()
+        types = collections.Counter()
+        started = time.monotonic()
+        for event in events:
+            # The same events watch_loop would have queued
+            metadata = event["object"].get("metadata")
+            if not metadata or not event["object"].get("spec"):
+                continue
+            if speed:
+                delay = event["t"] / speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            types[event["type"]] += 1
+            controller.enqueue_event(event, metadata.get("resourceVersion"))
+        controller.queue.join()
+        elapsed = time.monotonic() - started
+        credstash.get_session._cached_session = None
+
+    return {
+        "events": sum(types.values()),
+        "types": dict(types),
+        "coalesced": controller.queue.coalesced,
+        "recorded_seconds": events[-1]["t"] if events else 0,
+        "seconds": round(elapsed, 3),
+        "events_per_second": round(sum(types.values()) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p90_ms": round(percentile(latencies, 0.9) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "max_ms": round(max(latencies, default=0) * 1000, 1),
+        "kubernetes_calls": dict(controller.v1core.calls),
+        "aws_calls": dict(aws_calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Record a CredStashSecret watch and replay it against "
+        "local stand-ins"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser(
+        "record", help="Record the watch of the current kubeconfig's cluster"
+    )
+    record_parser.add_argument("output", help="Compressed when ending .gz")
+    record_parser.add_argument("--namespace")
+    record_parser.add_argument(
+        "--duration",
+        type=float,
+        help="Seconds to record for, until interrupted by default",
+    )
+    record_parser.add_argument(
+        "--existing",
+        action="store_true",
+        help="Start with the existing CredStashSecrets as ADDED events",
+    )
+
+    replay_parser = commands.add_parser("replay", help="Replay a recording")
+    replay_parser.add_argument("recording")
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1,
+        help="1 replays in real time, 10 ten times faster, 0 all at once",
+    )
+    replay_parser.add_argument(
+        "--engine", choices=sorted(ENGINES), default="threads"
+    )
+    replay_parser.add_argument("--workers", type=int, default=4)
+    replay_parser.add_argument("--fetch-workers", type=int, default=8)
+    replay_parser.add_argument("--debounce", type=float, default=0)
+    replay_parser.add_argument(
+        "--aws-latency",
+        type=float,
+        default=0,
+        help="Seconds added to every DynamoDB and KMS call",
+    )
+    replay_parser.add_argument(
+        "--api-latency",
+        type=float,
+        default=0,
+        help="Seconds added to every Kubernetes API call",
+    )
+    replay_parser.add_argument("--json", action="store_true")
+    replay_parser.add_argument(
+        "--verbose", action="store_true", help="Show the controller's output"
+    )
+    args = parser.parse_args()
+
+    if args.command == "record":
+        controller = CredStashController("", "", "", "", "*")
+        controller._init_client()
+        recorded = record(
+            controller,
+            args.output,
+            namespace=args.namespace,
+            duration=args.duration,
+            include_existing=args.existing,
+        )
+        print("Recorded {} events to {}".format(recorded, args.output))
+        return
+
+    # moto never talks to AWS, but boto3 still wants credentials
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+    events = load(args.recording)
+    output = io.StringIO()
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(output))
+        result = replay(
+            events,
+            speed=args.speed,
+            workers=args.workers,
+            fetch_workers=args.fetch_workers,
+            debounce=args.debounce,
+            aws_latency=args.aws_latency,
+            api_latency=args.api_latency,
+            controller_factory=ENGINES[args.engine],
+        )
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return
+    print(
+        "{events} events recorded over {recorded_seconds}s replayed in "
+        "{seconds}s, {coalesced} coalesced".format(**result)
+    )
+    print("{events_per_second} events/s".format(**result))
+    print(
+        "p50 {p50_ms}ms, p90 {p90_ms}ms, p99 {p99_ms}ms, "
+        "max {max_ms}ms".format(**result)
+    )
+    for kind in ("types", "kubernetes_calls", "aws_calls"):
+        for call, count in sorted(result[kind].items()):
+            print("{:>8} {}".format(count, call))
+
+
+if __name__ == "__main__":
+    main()
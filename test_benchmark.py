@@ -0,0 +1,30 @@
+import pytest
+
+pytest.importorskip("moto")
+
+from benchmark import ENGINES, make_workload, run_benchmark  # noqa: E402
+
+
+def test_make_workload():
+    keys, events = make_workload(crs=20, keys_per_cr=5, shared=0)
+    assert len(events) == 20
+    assert len(keys) == 100
+
+    keys, events = make_workload(crs=20, keys_per_cr=5, shared=1)
+    assert len(keys) <= 10
+
+
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_run_benchmark(engine):
+    result = run_benchmark(
+        crs=5,
+        keys_per_cr=3,
+        shared=0.5,
+        workers=2,
+        controller_factory=ENGINES[engine],
+    )
+
+    assert result["events"] == 5
+    assert result["kubernetes_calls"]["create_namespaced_secret"] == 5
+    assert result["aws_calls"]["kms:Decrypt"] == result["distinct_keys"]
+    assert result["p99_ms"] >= result["p50_ms"]
@@ -1,13 +1,61 @@
-from kubernetes.client import V1Secret, V1ObjectMeta
+import asyncio
+import base64
+import boto3
+import collections
+import concurrent.futures
+import credstash
+import datetime
+import multiprocessing
+import os
+import pytest
+from prometheus_client import REGISTRY
+import threading
+import time
+from kubernetes.client import (
+    V1ListMeta,
+    V1ObjectMeta,
+    V1OwnerReference,
+    V1Secret,
+    V1SecretList,
+)
+from botocore.exceptions import ClientError
 from kubernetes.client.rest import ApiException
-from unittest.mock import MagicMock, patch, Mock
+from unittest.mock import ANY, AsyncMock, MagicMock, call, patch, Mock
 from kubernetes.client.models.v1_delete_options import V1DeleteOptions
 
-from controller import CredStashController
+from controller import (
+    AsyncCredStashController,
+    CredStashController,
+    HashRing,
+    LatencyWindow,
+    MultiProcessController,
+    RateLimiter,
+    SecretCache,
+    SecretStore,
+    SingleFlight,
+    WorkQueue,
+)
 
 
-def test_update_secret_empty():
-    cont = CredStashController("none", "none", "none", "none", "none")
+@pytest.fixture(
+    params=[CredStashController, AsyncCredStashController],
+    ids=["threads", "asyncio"],
+)
+def engine(request):
+    return request.param
+
+
+def mock_update_secret(controller):
+    # The asyncio engine awaits its own version of update_secret
+    if isinstance(controller, AsyncCredStashController):
+        controller.update_secret_async = AsyncMock()
+        return controller.update_secret_async
+    controller.update_secret = MagicMock()
+    return controller.update_secret
+
+
+def test_update_secret_empty(engine):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     credstash_secret = {}
     cont.update_secret(credstash_secret, None)
@@ -15,8 +63,8 @@ def test_update_secret_empty():
     cont.v1core.create_namespaced_secret.assert_not_called()
 
 
-def test_update_secret_empty_spec():
-    cont = CredStashController("none", "none", "none", "none", "none")
+def test_update_secret_empty_spec(engine):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     cont.v1core.read_namespaced_secret = MagicMock(
         side_effect=ApiException(status=404)
@@ -40,6 +88,7 @@ def test_update_secret_empty_spec():
             "annotations": {
                 "credstash-fully-managed": "true",
                 "credstash-resourceversion": "1",
+                "credstash-spec-hash": ANY,
             },
             "cluster_name": None,
             "creation_timestamp": None,
@@ -49,7 +98,7 @@ def test_update_secret_empty_spec():
             "generate_name": None,
             "generation": None,
             "initializers": None,
-            "labels": None,
+            "labels": {"credstash.local/managed": "true"},
             "name": "boom",
             "namespace": "test",
             "owner_references": None,
@@ -62,8 +111,8 @@ def test_update_secret_empty_spec():
     }
 
 
-def test_update_secret_invalid_keys():
-    cont = CredStashController("none", "none", "none", "none", "none")
+def test_update_secret_invalid_keys(engine):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     credstash_secret = {
         "metadata": {"namespace": "test"},
@@ -75,8 +124,8 @@ def test_update_secret_invalid_keys():
 
 
 @patch("controller.credstash.getSecret", return_value="123")
-def test_update_secret_valid_key(credstash_get_secret_mock):
-    cont = CredStashController("none", "none", "none", "none", "none")
+def test_update_secret_valid_key(credstash_get_secret_mock, engine):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     cont.v1core.read_namespaced_secret = MagicMock(
         side_effect=ApiException(status=404)
@@ -100,6 +149,7 @@ def test_update_secret_valid_key(credstash_get_secret_mock):
             "annotations": {
                 "credstash-fully-managed": "true",
                 "credstash-resourceversion": "1",
+                "credstash-spec-hash": ANY,
             },
             "cluster_name": None,
             "creation_timestamp": None,
@@ -109,7 +159,7 @@ def test_update_secret_valid_key(credstash_get_secret_mock):
             "generate_name": None,
             "generation": None,
             "initializers": None,
-            "labels": None,
+            "labels": {"credstash.local/managed": "true"},
             "name": "boom",
             "namespace": "test",
             "owner_references": None,
@@ -122,8 +172,8 @@ def test_update_secret_valid_key(credstash_get_secret_mock):
     }
 
     credstash_get_secret_mock.assert_called_once_with(
-        aws_access_key_id="none",
-        aws_secret_access_key="none",
+        dynamodb=ANY,
+        kms=ANY,
         name="ba",
         region="none",
         table="none",
@@ -132,8 +182,10 @@ def test_update_secret_valid_key(credstash_get_secret_mock):
 
 
 @patch("controller.credstash.getSecret", return_value="123")
-def test_update_secret_valid_key_different_table(credstash_get_secret_mock):
-    cont = CredStashController("none", "none", "none", "none", "none")
+def test_update_secret_valid_key_different_table(
+    credstash_get_secret_mock, engine
+):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     cont.v1core.read_namespaced_secret = MagicMock(
         side_effect=ApiException(status=404)
@@ -164,6 +216,7 @@ def test_update_secret_valid_key_different_table(credstash_get_secret_mock):
             "annotations": {
                 "credstash-fully-managed": "true",
                 "credstash-resourceversion": "1",
+                "credstash-spec-hash": ANY,
             },
             "cluster_name": None,
             "creation_timestamp": None,
@@ -173,7 +226,7 @@ def test_update_secret_valid_key_different_table(credstash_get_secret_mock):
             "generate_name": None,
             "generation": None,
             "initializers": None,
-            "labels": None,
+            "labels": {"credstash.local/managed": "true"},
             "name": "boom",
             "namespace": "test",
             "owner_references": None,
@@ -186,8 +239,8 @@ def test_update_secret_valid_key_different_table(credstash_get_secret_mock):
     }
 
     credstash_get_secret_mock.assert_called_once_with(
-        aws_access_key_id="none",
-        aws_secret_access_key="none",
+        dynamodb=ANY,
+        kms=ANY,
         name="ba",
         region="none",
         table="development",
@@ -195,9 +248,12 @@ def test_update_secret_valid_key_different_table(credstash_get_secret_mock):
     )
 
 
+@patch("controller.CredStashController.prefetch_materials", return_value={})
 @patch("controller.credstash.getSecret", return_value="123")
-def test_update_secret_valid_key_multiple(credstash_get_secret_mock):
-    cont = CredStashController("none", "none", "none", "none", "none")
+def test_update_secret_valid_key_multiple(
+    credstash_get_secret_mock, _, engine
+):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     cont.v1core.read_namespaced_secret = MagicMock(
         side_effect=ApiException(status=404)
@@ -224,6 +280,7 @@ def test_update_secret_valid_key_multiple(credstash_get_secret_mock):
             "annotations": {
                 "credstash-fully-managed": "true",
                 "credstash-resourceversion": "-1",
+                "credstash-spec-hash": ANY,
             },
             "cluster_name": None,
             "creation_timestamp": None,
@@ -233,7 +290,7 @@ def test_update_secret_valid_key_multiple(credstash_get_secret_mock):
             "generate_name": None,
             "generation": None,
             "initializers": None,
-            "labels": None,
+            "labels": {"credstash.local/managed": "true"},
             "name": "boom",
             "namespace": "test",
             "owner_references": None,
@@ -245,9 +302,18 @@ def test_update_secret_valid_key_multiple(credstash_get_secret_mock):
         "type": None,
     }
 
-    credstash_get_secret_mock.assert_called_with(
-        aws_access_key_id="none",
-        aws_secret_access_key="none",
+    assert credstash_get_secret_mock.call_count == 2
+    credstash_get_secret_mock.assert_any_call(
+        dynamodb=ANY,
+        kms=ANY,
+        name="ba",
+        region="none",
+        table="none",
+        version="0001",
+    )
+    credstash_get_secret_mock.assert_any_call(
+        dynamodb=ANY,
+        kms=ANY,
         name="bo",
         region="none",
         table="none",
@@ -255,9 +321,63 @@ def test_update_secret_valid_key_multiple(credstash_get_secret_mock):
     )
 
 
+@patch("controller.CredStashController.prefetch_materials", return_value={})
+def test_update_secret_fetches_in_parallel(_, engine):
+    barrier = threading.Barrier(2, timeout=5)
+
+    def get_secret(**kwargs):
+        # Both fetches have to be in flight at once to get past this
+        barrier.wait()
+        return kwargs["name"]
+
+    cont = engine(
+        "none", "none", "none", "none", "none", fetch_workers=2
+    )
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    credstash_secret = {
+        "metadata": {"namespace": "test", "name": "boom"},
+        "spec": [
+            {"from": "ba", "name": "lala", "version": "0001"},
+            {"from": "bo", "name": "lala2", "version": "0001"},
+        ],
+    }
+    with patch("controller.credstash.getSecret", side_effect=get_secret):
+        cont.update_secret(credstash_secret, resource_version=None)
+
+    assert cont.v1core.create_namespaced_secret.call_args_list[0][0][
+        1
+    ].data == {"lala": "YmE=", "lala2": "Ym8="}
+
+
+@patch("controller.CredStashController.prefetch_materials", return_value={})
+@patch(
+    "controller.credstash.getSecret",
+    side_effect=["123", credstash.ItemNotFound()],
+)
+def test_update_secret_one_entry_missing(credstash_get_secret_mock, _, engine):
+    cont = engine("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    credstash_secret = {
+        "metadata": {"namespace": "test", "name": "boom"},
+        "spec": [
+            {"from": "ba", "name": "lala", "version": "0001"},
+            {"from": "bo", "name": "lala2", "version": "0001"},
+        ],
+    }
+    cont.update_secret(credstash_secret, resource_version=None)
+    cont.v1core.patch_namespaced_secret.assert_not_called()
+    cont.v1core.create_namespaced_secret.assert_not_called()
+
+
 @patch("controller.credstash.getSecret", return_value="123")
-def test_update_secret_valid_key_existing(credstash_get_secret_mock):
-    cont = CredStashController("none", "none", "none", "none", "none")
+def test_update_secret_valid_key_existing(credstash_get_secret_mock, engine):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     metadata = V1ObjectMeta(
         name="bobo",
@@ -276,40 +396,20 @@ def test_update_secret_valid_key_existing(credstash_get_secret_mock):
     assert (
         cont.v1core.patch_namespaced_secret.call_args_list[0][0][0] == "boom"
     )
-    assert cont.v1core.patch_namespaced_secret.call_args_list[0][0][
-        2
-    ].to_dict() == {
-        "api_version": "v1",
+    assert cont.v1core.patch_namespaced_secret.call_args_list[0][0][2] == {
         "data": {"lala": "MTIz"},
-        "kind": "Secret",
         "metadata": {
             "annotations": {
-                "credstash-fully-managed": "true",
                 "credstash-resourceversion": "10",
+                "credstash-spec-hash": ANY,
             },
-            "cluster_name": None,
-            "creation_timestamp": None,
-            "deletion_grace_period_seconds": None,
-            "deletion_timestamp": None,
-            "finalizers": None,
-            "generate_name": None,
-            "generation": None,
-            "initializers": None,
-            "labels": None,
-            "name": "bobo",
-            "namespace": "default",
-            "owner_references": None,
-            "resource_version": None,
-            "self_link": None,
-            "uid": None,
+            "labels": {"credstash.local/managed": "true"},
         },
-        "string_data": None,
-        "type": None,
     }
 
     credstash_get_secret_mock.assert_called_once_with(
-        aws_access_key_id="none",
-        aws_secret_access_key="none",
+        dynamodb=ANY,
+        kms=ANY,
         name="ba",
         region="none",
         table="none",
@@ -318,8 +418,8 @@ def test_update_secret_valid_key_existing(credstash_get_secret_mock):
 
 
 @patch("controller.credstash.getSecret", return_value="123")
-def test_update_secret_bad_resource_version(credstash_get_secret_mock):
-    cont = CredStashController("none", "none", "none", "none", "none")
+def test_update_secret_bad_resource_version(credstash_get_secret_mock, engine):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     metadata = V1ObjectMeta(
         name="bobo",
@@ -344,9 +444,9 @@ def test_update_secret_bad_resource_version(credstash_get_secret_mock):
 
 @patch("controller.credstash.getSecret", return_value="123")
 def test_update_secret_valid_key_existing_not_managed(
-    credstash_get_secret_mock
+    credstash_get_secret_mock, engine
 ):
-    cont = CredStashController("none", "none", "none", "none", "none")
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     metadata = V1ObjectMeta(
         name="bobo",
@@ -365,40 +465,21 @@ def test_update_secret_valid_key_existing_not_managed(
     assert (
         cont.v1core.patch_namespaced_secret.call_args_list[0][0][0] == "boom"
     )
-    assert cont.v1core.patch_namespaced_secret.call_args_list[0][0][
-        2
-    ].to_dict() == {
-        "api_version": "v1",
-        "data": {"lala": "MTIz", "secret": "poo"},
-        "kind": "Secret",
+    # The key the controller doesn't manage is left alone
+    assert cont.v1core.patch_namespaced_secret.call_args_list[0][0][2] == {
+        "data": {"lala": "MTIz"},
         "metadata": {
             "annotations": {
-                "credstash-fully-managed": "false",
                 "credstash-resourceversion": "1",
+                "credstash-spec-hash": ANY,
             },
-            "cluster_name": None,
-            "creation_timestamp": None,
-            "deletion_grace_period_seconds": None,
-            "deletion_timestamp": None,
-            "finalizers": None,
-            "generate_name": None,
-            "generation": None,
-            "initializers": None,
-            "labels": None,
-            "name": "bobo",
-            "namespace": "default",
-            "owner_references": None,
-            "resource_version": None,
-            "self_link": None,
-            "uid": None,
+            "labels": {"credstash.local/managed": "true"},
         },
-        "string_data": None,
-        "type": None,
     }
 
     credstash_get_secret_mock.assert_called_once_with(
-        aws_access_key_id="none",
-        aws_secret_access_key="none",
+        dynamodb=ANY,
+        kms=ANY,
         name="ba",
         region="none",
         table="none",
@@ -406,16 +487,16 @@ def test_update_secret_valid_key_existing_not_managed(
     )
 
 
-def test_delete_secret_empty():
-    cont = CredStashController("none", "none", "none", "none", "none")
+def test_delete_secret_empty(engine):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     credstash_secret = {"metadata": {"namespace": "test", "name": "boom"}}
     cont.delete_secret(credstash_secret, resource_version=1)
     cont.v1core.delete_secret.assert_not_called()
 
 
-def test_delete_secret_not_managed():
-    cont = CredStashController("none", "none", "none", "none", "none")
+def test_delete_secret_not_managed(engine):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     credstash_secret = {
         "metadata": {"namespace": "test", "name": "boom"},
@@ -425,8 +506,8 @@ def test_delete_secret_not_managed():
     cont.v1core.delete_secret.assert_not_called()
 
 
-def test_delete_secret():
-    cont = CredStashController("none", "none", "none", "none", "none")
+def test_delete_secret(engine):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     credstash_secret = {
         "metadata": {"namespace": "test", "name": "boom"},
@@ -445,8 +526,121 @@ def test_delete_secret():
     )
 
 
-def test_process_event_invalid_namespace():
-    controller = CredStashController("none", "none", "none", "none", "none")
+def test_delete_secret_owned_by_credstash_secret(engine):
+    cont = engine("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    secret_obj = managed_secret("boom", "test", "7")
+    secret_obj.metadata.owner_references = [
+        V1OwnerReference(
+            api_version="credstash.local/v1",
+            kind="CredStashSecret",
+            name="boom",
+            uid="abc",
+            controller=True,
+        )
+    ]
+    cont.secrets.replace([secret_obj])
+    credstash_secret = {
+        "metadata": {"namespace": "test", "name": "boom", "uid": "abc"}
+    }
+    cont.delete_secret(credstash_secret, resource_version=10)
+
+    # The garbage collector deletes it
+    cont.v1core.read_namespaced_secret.assert_not_called()
+    cont.v1core.delete_namespaced_secret.assert_not_called()
+    assert cont.secrets.get("test", "boom") is None
+
+
+def test_update_secret_owned_by_credstash_secret(engine):
+    cont = engine("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret.side_effect = ApiException(status=404)
+    credstash_secret = {
+        "metadata": {"namespace": "test", "name": "boom", "uid": "abc"},
+        "spec": [],
+    }
+    cont.update_secret(credstash_secret, resource_version=1)
+
+    created = cont.v1core.create_namespaced_secret.call_args[0][1]
+    assert [
+        owner.to_dict() for owner in created.metadata.owner_references
+    ] == [
+        {
+            "api_version": "credstash.local/v1",
+            "block_owner_deletion": None,
+            "controller": True,
+            "kind": "CredStashSecret",
+            "name": "boom",
+            "uid": "abc",
+        }
+    ]
+
+
+def test_update_secret_adopted_by_recreated_credstash_secret(engine):
+    cont = engine("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    credstash_secret = {
+        "metadata": {"namespace": "test", "name": "boom", "uid": "new"},
+        "spec": [],
+    }
+    secret_obj = managed_secret(
+        "boom",
+        "test",
+        "7",
+        annotations={
+            "credstash-fully-managed": "true",
+            "credstash-spec-hash": cont.spec_hash([]),
+        },
+    )
+    secret_obj.metadata.owner_references = [
+        V1OwnerReference(
+            api_version="v1",
+            kind="ConfigMap",
+            name="other",
+            uid="other",
+        ),
+        V1OwnerReference(
+            api_version="credstash.local/v1",
+            kind="CredStashSecret",
+            name="boom",
+            uid="old",
+            controller=True,
+        ),
+    ]
+    cont.v1core.read_namespaced_secret.return_value = secret_obj
+    cont.v1core.patch_namespaced_secret.side_effect = (
+        lambda name, namespace, patch: managed_secret(name, namespace, "8")
+    )
+
+    # Even though its spec is unchanged
+    cont.update_secret(credstash_secret, resource_version=10)
+
+    patch = cont.v1core.patch_namespaced_secret.call_args[0][2]
+    assert patch["metadata"]["ownerReferences"] == [
+        {
+            "apiVersion": "v1",
+            "kind": "ConfigMap",
+            "name": "other",
+            "uid": "other",
+        },
+        {
+            "apiVersion": "credstash.local/v1",
+            "controller": True,
+            "kind": "CredStashSecret",
+            "name": "boom",
+            "uid": "new",
+        },
+    ]
+
+    # Once it's owned by the current one there's nothing to do
+    cont.v1core.patch_namespaced_secret.reset_mock()
+    secret_obj.metadata.owner_references[1].uid = "new"
+    cont.update_secret(credstash_secret, resource_version=10)
+    cont.v1core.patch_namespaced_secret.assert_not_called()
+
+
+def test_process_event_invalid_namespace(engine):
+    controller = engine("none", "none", "none", "none", "none")
 
     event = {
         "object": {
@@ -460,8 +654,8 @@ def test_process_event_invalid_namespace():
     controller.delete_secret.assert_not_called()
 
 
-def test_process_event_no_spec():
-    controller = CredStashController("none", "none", "none", "none", "none")
+def test_process_event_no_spec(engine):
+    controller = engine("none", "none", "none", "none", "none")
 
     event = {
         "object": {
@@ -475,8 +669,8 @@ def test_process_event_no_spec():
     controller.delete_secret.assert_not_called()
 
 
-def test_process_event_delete():
-    controller = CredStashController("none", "none", "none", "none", "boom")
+def test_process_event_delete(engine):
+    controller = engine("none", "none", "none", "none", "boom")
 
     event = {
         "object": {
@@ -490,8 +684,8 @@ def test_process_event_delete():
     controller.delete_secret.assert_called_once_with(event["object"], None)
 
 
-def test_process_event_delete_wildcard_ns():
-    controller = CredStashController("none", "none", "none", "none", "*")
+def test_process_event_delete_wildcard_ns(engine):
+    controller = engine("none", "none", "none", "none", "*")
 
     event = {
         "object": {
@@ -505,8 +699,8 @@ def test_process_event_delete_wildcard_ns():
     controller.delete_secret.assert_called_once_with(event["object"], None)
 
 
-def test_process_event_modified():
-    controller = CredStashController("none", "none", "none", "none", "boom")
+def test_process_event_modified(engine):
+    controller = engine("none", "none", "none", "none", "boom")
 
     event = {
         "object": {
@@ -515,13 +709,13 @@ def test_process_event_modified():
         },
         "type": "MODIFIED",
     }
-    controller.update_secret = MagicMock()
+    update_secret = mock_update_secret(controller)
     controller.process_event(event)
-    controller.update_secret.assert_called_once_with(event["object"], None)
+    update_secret.assert_called_once_with(event["object"], None)
 
 
-def test_process_event_created():
-    controller = CredStashController("none", "none", "none", "none", "boom")
+def test_process_event_created(engine):
+    controller = engine("none", "none", "none", "none", "boom")
 
     event = {
         "object": {
@@ -530,14 +724,14 @@ def test_process_event_created():
         },
         "type": "ADDED",
     }
-    controller.update_secret = MagicMock()
+    update_secret = mock_update_secret(controller)
     controller.process_event(event)
-    controller.update_secret.assert_called_once_with(event["object"], None)
+    update_secret.assert_called_once_with(event["object"], None)
 
 
 @patch("controller.credstash.getSecret", return_value="123")
-def test_delete_secret_bad_resource_version(credstash_get_secret_mock):
-    cont = CredStashController("none", "none", "none", "none", "none")
+def test_delete_secret_bad_resource_version(credstash_get_secret_mock, engine):
+    cont = engine("none", "none", "none", "none", "none")
     cont.v1core = MagicMock()
     metadata = V1ObjectMeta(
         name="bobo",
@@ -558,3 +752,1960 @@ def test_delete_secret_bad_resource_version(credstash_get_secret_mock):
     credstash_get_secret_mock.assert_not_called()
     cont.v1core.patch_namespaced_secret.assert_not_called()
     cont.v1core.delete_namespaced_secret.assert_not_called()
+
+
+def test_work_queue_serializes_same_key():
+    queue = WorkQueue()
+    queue.put("ns/a", 1)
+    queue.put("ns/b", 3)
+
+    assert queue.get() == ("ns/a", 1)
+    queue.put("ns/a", 2)
+    # ns/a is still being processed, so its next event has to wait
+    assert queue.get() == ("ns/b", 3)
+    assert len(queue) == 1
+    queue.done("ns/a")
+    assert queue.get() == ("ns/a", 2)
+
+
+def test_work_queue_coalesces_waiting_events():
+    queue = WorkQueue()
+    assert not queue.put("ns/a", 1)
+    assert queue.put("ns/a", 2)
+    assert queue.put("ns/a", 3)
+    queue.put("ns/b", 4)
+
+    assert queue.get() == ("ns/a", 3)
+    assert queue.get() == ("ns/b", 4)
+    assert queue.coalesced == 2
+
+
+@patch("controller.time.monotonic")
+def test_work_queue_debounce(monotonic_mock):
+    monotonic_mock.return_value = 100
+    queue = WorkQueue(debounce=5)
+    queue.put("ns/a", 1)
+    monotonic_mock.return_value = 104
+    queue.put("ns/a", 2)
+    result = []
+    getter = threading.Thread(target=lambda: result.append(queue.get()))
+    getter.start()
+    getter.join(0.1)
+    assert getter.is_alive()
+
+    monotonic_mock.return_value = 105
+    with queue._cond:
+        queue._cond.notify_all()
+    getter.join(5)
+    assert result == [("ns/a", 2)]
+
+
+def test_enqueue_event_deleted_wins():
+    controller = CredStashController("none", "none", "none", "none", "*")
+
+    def event(operation):
+        return {
+            "object": {
+                "spec": [{"name": "lala"}],
+                "metadata": {"namespace": "boom", "name": "test"},
+            },
+            "type": operation,
+        }
+
+    controller.enqueue_event(event("MODIFIED"), "1")
+    controller.enqueue_event(event("DELETED"), "2")
+    controller.enqueue_event(event("MODIFIED"), "3")
+
+    assert controller.queue.get() == ("boom/test", (event("DELETED"), "2"))
+    assert controller.queue.coalesced == 2
+
+
+def test_work_queue_max_depth():
+    queue = WorkQueue(max_depth=1)
+    queue.put("ns/a", 1)
+    putter = threading.Thread(target=queue.put, args=("ns/b", 2))
+    putter.start()
+    putter.join(0.1)
+    assert putter.is_alive()
+    assert queue.get() == ("ns/a", 1)
+    putter.join(5)
+    assert not putter.is_alive()
+    assert queue.get() == ("ns/b", 2)
+
+
+def test_workers_process_queued_events(engine):
+    controller = engine("none", "none", "none", "none", "*", workers=2)
+    processed = threading.Event()
+    update_secret = mock_update_secret(controller)
+    update_secret.side_effect = lambda *args: processed.set()
+    event = {
+        "object": {
+            "spec": {"boom"},
+            "metadata": {"namespace": "boom", "name": "test"},
+        },
+        "type": "ADDED",
+    }
+    controller.start_workers()
+    controller.enqueue_event(event, "5")
+    assert processed.wait(5)
+    update_secret.assert_called_once_with(event["object"], "5")
+
+
+def test_async_engine_overlaps_events():
+    controller = AsyncCredStashController(
+        "none", "none", "none", "none", "*", workers=1
+    )
+    started = []
+    release = threading.Event()
+
+    async def update_secret(credstash_secret, resource_version):
+        started.append(credstash_secret["metadata"]["name"])
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+
+    controller.update_secret_async = update_secret
+    controller.start_workers()
+    for name in ("a", "b", "c"):
+        controller.enqueue_event(
+            {
+                "object": {
+                    "spec": {"boom"},
+                    "metadata": {"namespace": "boom", "name": name},
+                },
+                "type": "ADDED",
+            }
+        )
+    deadline = time.monotonic() + 5
+    # None of them finish until all three are in flight on the one loop
+    while len(started) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    controller.queue.join()
+    assert sorted(started) == ["a", "b", "c"]
+
+
+def test_async_engine_calls_apart_from_fetches():
+    controller = AsyncCredStashController(
+        "none", "none", "none", "none", "*", workers=1, fetch_workers=1
+    )
+    assert controller.concurrency == 2
+    release = threading.Event()
+    # Every fetch thread is busy
+    controller.fetch_pool.submit(release.wait, 5)
+    try:
+        assert asyncio.run(
+            asyncio.wait_for(controller.call(lambda: "called"), 1)
+        ) == "called"
+    finally:
+        release.set()
+
+
+def test_secret_cache_evicts_least_recently_used():
+    cache = SecretCache(max_size=2)
+    cache.put(("t", "a", "1"), "s3cr3t")
+    cache.put(("t", "b", "1"), "b")
+    assert cache.get(("t", "a", "1")) == "s3cr3t"
+    cache.put(("t", "c", "1"), "c")
+
+    assert cache.get(("t", "b", "1")) is None
+    assert cache.get(("t", "a", "1")) == "s3cr3t"
+    assert cache.get(("t", "c", "1")) == "c"
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert "s3cr3t" not in repr(cache)
+
+
+@patch("controller.time.monotonic")
+def test_secret_cache_ttl(monotonic_mock):
+    monotonic_mock.return_value = 100
+    cache = SecretCache(ttl=10)
+    cache.put(("t", "a", "1"), "a")
+    monotonic_mock.return_value = 109
+    assert cache.get(("t", "a", "1")) == "a"
+    monotonic_mock.return_value = 111
+    assert cache.get(("t", "a", "1")) is None
+    assert len(cache) == 0
+
+
+@patch("controller.credstash.getSecret", return_value="123")
+def test_update_secret_uses_cache(credstash_get_secret_mock, engine):
+    cont = engine("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    credstash_secret = {
+        "metadata": {"namespace": "test", "name": "boom"},
+        "spec": [{"from": "ba", "name": "lala", "version": "0001"}],
+    }
+    cont.update_secret(credstash_secret, resource_version=1)
+    cont.update_secret(credstash_secret, resource_version=2)
+
+    assert cont.v1core.create_namespaced_secret.call_count == 2
+    assert cont.v1core.create_namespaced_secret.call_args_list[1][0][
+        1
+    ].data == {"lala": "MTIz"}
+    credstash_get_secret_mock.assert_called_once()
+    assert (cont.cache.hits, cont.cache.misses) == (1, 1)
+
+
+def test_single_flight_shares_result():
+    flight = SingleFlight()
+    release = threading.Event()
+    fetch = MagicMock(side_effect=lambda: release.wait(5) and "123")
+    results = []
+
+    def call():
+        results.append(flight.do(("t", "a", "1"), fetch))
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for _ in range(500):
+        if flight.shared == 2:
+            break
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["123", "123", "123"]
+    fetch.assert_called_once()
+
+
+def test_single_flight_abandoned_lead():
+    flight = SingleFlight()
+    assert flight.lead(["a", "b"]) == ["a", "b"]
+    assert flight.lead(["a", "c"]) == ["c"]
+    assert flight.claim("a")
+    assert not flight.claim("a")
+
+    results = []
+    waiter = threading.Thread(
+        target=lambda: results.append(flight.do("b", lambda: "fetched"))
+    )
+    waiter.start()
+    flight.abandon(["a", "b", "c"])
+    waiter.join(5)
+
+    # "b" was never claimed, so the waiter fetched it itself
+    assert results == ["fetched"]
+    assert flight.resolve("a", lambda: "batched") == "batched"
+
+
+def test_single_flight_error_releases_key():
+    flight = SingleFlight()
+    with pytest.raises(credstash.ItemNotFound):
+        flight.do("a", MagicMock(side_effect=credstash.ItemNotFound()))
+    assert flight.do("a", lambda: "ok") == "ok"
+
+
+@pytest.fixture
+def credstash_table():
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        session = boto3.Session(
+            aws_access_key_id="none",
+            aws_secret_access_key="none",
+            region_name="us-east-1",
+        )
+        # credstash's own helpers below use its global session
+        credstash.get_session._cached_session = session
+        kms = session.client("kms")
+        key_id = kms.create_key()["KeyMetadata"]["KeyId"]
+        kms.create_alias(AliasName="alias/credstash", TargetKeyId=key_id)
+        credstash.createDdbTable(region="us-east-1", table="credstash")
+
+        def put_secret(name, value, version=1):
+            credstash.putSecret(
+                name,
+                value,
+                version=credstash.paddedInt(version),
+                region="us-east-1",
+                table="credstash",
+            )
+
+        yield put_secret
+    credstash.get_session._cached_session = None
+
+
+def test_update_secret_batch_fetch(credstash_table, engine):
+    spec = []
+    for i in range(150):
+        credstash_table("key{}".format(i), "value{}".format(i))
+        spec.append(
+            {
+                "from": "key{}".format(i),
+                "name": "NAME{}".format(i),
+                "version": credstash.paddedInt(1),
+            }
+        )
+    cont = engine(
+        "none", "none", "us-east-1", "credstash", "*"
+    )
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    calls = collections.Counter()
+    cont.aws_session().events.register(
+        "before-call.dynamodb",
+        lambda model, **kwargs: calls.update([model.name]),
+    )
+
+    with patch(
+        "controller.credstash.getSecret", wraps=credstash.getSecret
+    ) as credstash_get_secret_mock:
+        cont.update_secret(
+            {"metadata": {"namespace": "test", "name": "boom"}, "spec": spec},
+            resource_version=1,
+        )
+
+    credstash_get_secret_mock.assert_not_called()
+    assert calls == {"BatchGetItem": 2}
+    data = cont.v1core.create_namespaced_secret.call_args_list[0][0][1].data
+    assert len(data) == 150
+    assert base64.b64decode(data["NAME42"]).decode() == "value42"
+
+    # The same spec one key at a time is a GetItem per entry
+    cont = engine(
+        "none", "none", "us-east-1", "credstash", "*"
+    )
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    calls.clear()
+    cont.aws_session().events.register(
+        "before-call.dynamodb",
+        lambda model, **kwargs: calls.update([model.name]),
+    )
+    with patch.object(cont, "prefetch_materials", return_value={}):
+        cont.update_secret(
+            {"metadata": {"namespace": "test", "name": "boom"}, "spec": spec},
+            resource_version=1,
+        )
+    assert calls == {"GetItem": 150}
+
+
+def test_update_secret_batch_fetch_shared_between_updates(
+    credstash_table, engine
+):
+    spec = []
+    for i in range(3):
+        credstash_table("key{}".format(i), "value{}".format(i))
+        spec.append(
+            {
+                "from": "key{}".format(i),
+                "name": "NAME{}".format(i),
+                "version": credstash.paddedInt(1),
+            }
+        )
+    cont = engine(
+        "none", "none", "us-east-1", "credstash", "*", cache_size=0
+    )
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    calls = collections.Counter()
+    batch_started = threading.Event()
+
+    def before_call(model, **kwargs):
+        calls.update([model.name])
+        if model.name == "BatchGetItem":
+            batch_started.set()
+            # Give the second update time to find the keys in flight
+            time.sleep(0.5)
+
+    cont.aws_session().events.register("before-call.dynamodb", before_call)
+
+    def update(name):
+        cont.update_secret(
+            {"metadata": {"namespace": "test", "name": name}, "spec": spec},
+            resource_version=1,
+        )
+
+    first = threading.Thread(target=update, args=("first",))
+    first.start()
+    assert batch_started.wait(10)
+    second = threading.Thread(target=update, args=("second",))
+    second.start()
+    first.join(30)
+    second.join(30)
+
+    assert calls == {"BatchGetItem": 1}
+    assert cont.in_flight.shared == 3
+    created = cont.v1core.create_namespaced_secret.call_args_list
+    assert len(created) == 2
+    assert created[0][0][1].data == created[1][0][1].data
+
+
+def test_update_secret_batch_fetch_shared_with_small_pool(
+    credstash_table, engine
+):
+    spec = []
+    for i in range(3):
+        credstash_table("key{}".format(i), "value{}".format(i))
+        spec.append(
+            {
+                "from": "key{}".format(i),
+                "name": "NAME{}".format(i),
+                "version": credstash.paddedInt(1),
+            }
+        )
+    # Fewer fetch threads than the second update has entries to wait on
+    cont = engine(
+        "none",
+        "none",
+        "us-east-1",
+        "credstash",
+        "*",
+        fetch_workers=2,
+        cache_size=0,
+    )
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    batch_get_items = cont.batch_get_items
+    batch_started = threading.Event()
+
+    def slow_batch_get_items(table, keys):
+        batch_started.set()
+        time.sleep(0.5)
+        return batch_get_items(table, keys)
+
+    cont.batch_get_items = slow_batch_get_items
+
+    def update(name):
+        cont.update_secret(
+            {"metadata": {"namespace": "test", "name": name}, "spec": spec},
+            resource_version=1,
+        )
+
+    first = threading.Thread(target=update, args=("first",), daemon=True)
+    first.start()
+    assert batch_started.wait(10)
+    second = threading.Thread(target=update, args=("second",), daemon=True)
+    second.start()
+    first.join(10)
+    second.join(10)
+
+    assert not first.is_alive() and not second.is_alive()
+    assert cont.v1core.create_namespaced_secret.call_count == 2
+
+
+def test_prefetch_materials_failed_batch_releases_every_table():
+    cont = CredStashController("none", "none", "none", "first", "*")
+    items = {
+        ("a", "1"): {"name": "a"},
+        ("b", "1"): {"name": "b"},
+    }
+
+    def batch_get_items(table, keys):
+        if table == "second":
+            raise throttling_error()
+        return items
+
+    cont.batch_get_items = batch_get_items
+    spec = [
+        {"from": "a", "name": "A", "version": "1"},
+        {"from": "b", "name": "B", "version": "1"},
+        {"from": "c", "name": "C", "version": "1", "table": "second"},
+        {"from": "d", "name": "D", "version": "1", "table": "second"},
+    ]
+
+    with pytest.raises(ClientError):
+        cont.prefetch_materials(spec)
+
+    # Nothing is left for later fetches to wait on forever
+    assert cont.in_flight.lead(
+        [("first", "a", "1"), ("first", "b", "1"), ("second", "c", "1")]
+    ) == [("first", "a", "1"), ("first", "b", "1"), ("second", "c", "1")]
+
+
+def test_update_secret_batch_fetch_missing(credstash_table, engine):
+    credstash_table("key1", "value1")
+    cont = engine(
+        "none", "none", "us-east-1", "credstash", "*"
+    )
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    spec = [
+        {"from": "key1", "name": "ONE", "version": credstash.paddedInt(1)},
+        {"from": "key2", "name": "TWO", "version": credstash.paddedInt(1)},
+    ]
+    cont.update_secret(
+        {"metadata": {"namespace": "test", "name": "boom"}, "spec": spec},
+        resource_version=1,
+    )
+    cont.v1core.create_namespaced_secret.assert_not_called()
+
+
+@patch("controller.time.sleep")
+def test_batch_get_items_retries_unprocessed_keys(sleep_mock):
+    cont = CredStashController("none", "none", "none", "none", "*")
+    dynamodb = MagicMock()
+    dynamodb.batch_get_item.side_effect = [
+        {
+            "Responses": {"t": [{"name": "a", "version": "1"}]},
+            "UnprocessedKeys": {
+                "t": {"Keys": [{"name": "b", "version": "1"}]}
+            },
+        },
+        {"Responses": {"t": [{"name": "b", "version": "1"}]}},
+    ]
+    cont.aws_session = MagicMock()
+    cont.aws_session.return_value.resource.return_value = dynamodb
+
+    items = cont.batch_get_items("t", [("a", "1"), ("b", "1"), ("c", "1")])
+
+    assert items == {
+        ("a", "1"): {"name": "a", "version": "1"},
+        ("b", "1"): {"name": "b", "version": "1"},
+        ("c", "1"): None,
+    }
+    assert dynamodb.batch_get_item.call_args_list[1][1] == {
+        "RequestItems": {"t": {"Keys": [{"name": "b", "version": "1"}]}}
+    }
+    sleep_mock.assert_called_once()
+
+
+def throttling_error(code="ProvisionedThroughputExceededException"):
+    return ClientError({"Error": {"Code": code}}, "GetItem")
+
+
+@patch("controller.time.sleep")
+@patch("controller.time.monotonic")
+def test_rate_limiter_aimd(monotonic_mock, sleep_mock):
+    monotonic_mock.return_value = 100
+    limiter = RateLimiter(8)
+    for _ in range(8):
+        limiter.acquire()
+    sleep_mock.assert_not_called()
+
+    # Out of tokens, so it waits for the next one
+    def sleep(seconds):
+        monotonic_mock.return_value += seconds
+
+    sleep_mock.side_effect = sleep
+    limiter.acquire()
+    sleep_mock.assert_called_once_with(0.125)
+
+    monotonic_mock.return_value = 100
+    limiter.throttled()
+    assert limiter.rate == 4
+    monotonic_mock.return_value = 101
+    limiter.throttled()
+    assert limiter.rate == 2
+    limiter.succeeded()
+    assert limiter.rate == 2
+    monotonic_mock.return_value = 102
+    limiter.succeeded()
+    assert limiter.rate == 3
+    for second in range(103, 120):
+        monotonic_mock.return_value = second
+        limiter.succeeded()
+    assert limiter.rate == 8
+
+
+def test_rate_limiter_halves_once_for_concurrent_throttling():
+    limiter = RateLimiter(64)
+    callers = [
+        threading.Thread(target=limiter.throttled) for _ in range(16)
+    ]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+
+    assert limiter.rate == 32
+
+
+def test_aws_throttling_slows_down():
+    cont = CredStashController("none", "none", "none", "none", "*")
+    model = MagicMock()
+    model.service_model.service_name = "kms"
+    throttled = metric("credstash_controller_throttled_total", backend="kms")
+
+    cont.after_aws_call(model, {"Error": {"Code": "ThrottlingException"}})
+
+    assert cont.limiters["kms"].rate == 50
+    assert cont.limiters["dynamodb"].rate == 100
+    assert (
+        metric("credstash_controller_throttled_total", backend="kms")
+        == throttled + 1
+    )
+
+
+def test_secret_api_throttling_slows_down():
+    cont = CredStashController("none", "none", "none", "none", "*")
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret.side_effect = ApiException(status=429)
+
+    with pytest.raises(ApiException):
+        cont.read_secret("boom", "test")
+    assert cont.limiters["kubernetes"].rate == 25
+
+
+@patch("controller.credstash.getSecret", side_effect=throttling_error())
+def test_update_secret_throttled(credstash_get_secret_mock, engine):
+    cont = engine("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    credstash_secret = {
+        "metadata": {"namespace": "test", "name": "boom"},
+        "spec": [{"from": "ba", "name": "lala", "version": "0001"}],
+    }
+
+    # Left for the worker to retry instead of bailing out
+    with pytest.raises(ClientError):
+        cont.update_secret(credstash_secret, resource_version=1)
+    cont.v1core.create_namespaced_secret.assert_not_called()
+
+
+@pytest.mark.parametrize("keys", [1, 2], ids=["get_secret", "batch"])
+def test_update_secret_kms_throttled(credstash_table, engine, keys):
+    spec = []
+    for i in range(keys):
+        credstash_table("key{}".format(i), "value{}".format(i))
+        spec.append(
+            {
+                "from": "key{}".format(i),
+                "name": "NAME{}".format(i),
+                "version": credstash.paddedInt(1),
+            }
+        )
+    cont = engine("none", "none", "us-east-1", "credstash", "*")
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    kms = MagicMock()
+    kms.decrypt.side_effect = throttling_error("ThrottlingException")
+    cont.aws_client = MagicMock(return_value=kms)
+    event = {
+        "type": "ADDED",
+        "object": {
+            "metadata": {"namespace": "test", "name": "boom"},
+            "spec": spec,
+        },
+    }
+
+    # credstash's KeyService wraps it in a KmsError
+    with pytest.raises(credstash.KmsError) as error:
+        cont.update_secret(event["object"], resource_version=1)
+    assert (
+        cont.event_failed("test/boom", event, 1, error.value) == "throttled"
+    )
+    cont.v1core.create_namespaced_secret.assert_not_called()
+
+
+@patch("controller.random.uniform", return_value=0.01)
+def test_throttled_event_is_requeued(uniform_mock, engine):
+    controller = engine("none", "none", "none", "none", "*")
+    attempts = []
+
+    def update_secret(credstash_secret, resource_version):
+        attempts.append(resource_version)
+        if len(attempts) < 3:
+            raise throttling_error()
+
+    update_secret_mock = mock_update_secret(controller)
+    update_secret_mock.side_effect = update_secret
+    controller.start_workers()
+    controller.enqueue_event(
+        {
+            "object": {
+                "spec": {"boom"},
+                "metadata": {"namespace": "boom", "name": "test"},
+            },
+            "type": "ADDED",
+        },
+        "5",
+    )
+    controller.queue.join()
+
+    assert attempts == ["5", "5", "5"]
+    assert controller._throttle_attempts == {}
+
+
+def test_work_queue_requeue_keeps_newer_event():
+    queue = WorkQueue()
+    queue.put("ns/a", 1)
+    assert queue.get() == ("ns/a", 1)
+    queue.put("ns/a", 2)
+
+    assert not queue.requeue("ns/a", 1, 0)
+    queue.done("ns/a")
+    assert queue.get() == ("ns/a", 2)
+
+@patch("controller.credstash.getSecret", return_value="123")
+def test_get_secret_reuses_clients(credstash_get_secret_mock):
+    cont = CredStashController(
+        "none", "none", "us-east-1", "none", "none", fetch_workers=3
+    )
+    cont.get_secret("t", "a", "1")
+    cont.get_secret("t", "b", "1")
+
+    first, second = credstash_get_secret_mock.call_args_list
+    assert first[1]["dynamodb"] is second[1]["dynamodb"]
+    assert first[1]["kms"] is second[1]["kms"]
+    assert first[1]["kms"] is cont.aws_client("kms")
+    assert first[1]["kms"].meta.config.max_pool_connections == 7
+    assert cont.aws_client("kms", "eu-west-1") is not first[1]["kms"]
+
+    other_thread = []
+    thread = threading.Thread(
+        target=lambda: other_thread.append(cont.aws_resource("dynamodb"))
+    )
+    thread.start()
+    thread.join(5)
+    assert other_thread[0] is not first[1]["dynamodb"]
+
+
+def test_update_secret_concurrent_fetches(credstash_table, engine):
+    cont = engine(
+        "none",
+        "none",
+        "us-east-1",
+        "credstash",
+        "*",
+        fetch_workers=4,
+        cache_size=0,
+    )
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    # Single key specs skip BatchGetItem, so every fetch uses getSecret
+    for i in range(16):
+        credstash_table("key{}".format(i), "value{}".format(i))
+    threads = [
+        threading.Thread(
+            target=cont.update_secret,
+            args=(
+                {
+                    "metadata": {"namespace": "test", "name": str(i)},
+                    "spec": [
+                        {
+                            "from": "key{}".format(i),
+                            "name": "VALUE",
+                            "version": credstash.paddedInt(1),
+                        }
+                    ],
+                },
+                1,
+            ),
+        )
+        for i in range(16)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    created = {
+        args[0][1].metadata.name: base64.b64decode(
+            args[0][1].data["VALUE"]
+        ).decode()
+        for args in cont.v1core.create_namespaced_secret.call_args_list
+    }
+    assert created == {str(i): "value{}".format(i) for i in range(16)}
+
+
+def managed_secret(name, namespace, resource_version, annotations=None):
+    metadata = V1ObjectMeta(
+        name=name,
+        namespace=namespace,
+        resource_version=resource_version,
+        annotations=annotations or {"credstash-fully-managed": "true"},
+        labels={"credstash.local/managed": "true"},
+    )
+    return V1Secret("v1", {}, "Secret", metadata)
+
+
+def test_secret_store_keeps_newest():
+    store = SecretStore()
+    store.put(managed_secret("a", "ns", "5"))
+    store.put(managed_secret("a", "ns", "3"))
+    assert store.get("ns", "a").metadata.resource_version == "5"
+
+    copied = store.get("ns", "a")
+    copied.metadata.annotations["credstash-resourceversion"] = "10"
+    assert "credstash-resourceversion" not in (
+        store.get("ns", "a").metadata.annotations
+    )
+
+    store.delete("ns", "a")
+    assert store.get("ns", "a") is None
+
+
+@patch("controller.credstash.getSecret", return_value="123")
+def test_update_secret_reads_from_store(credstash_get_secret_mock, engine):
+    cont = engine("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    cont.secrets.replace([managed_secret("boom", "test", "7")])
+    patched = managed_secret("boom", "test", "8")
+    cont.v1core.patch_namespaced_secret.return_value = patched
+    credstash_secret = {
+        "metadata": {"namespace": "test", "name": "boom"},
+        "spec": [{"from": "ba", "name": "lala", "version": "0001"}],
+    }
+    cont.update_secret(credstash_secret, resource_version=10)
+
+    cont.v1core.read_namespaced_secret.assert_not_called()
+    assert cont.v1core.patch_namespaced_secret.call_args_list[0][0][2][
+        "metadata"
+    ]["annotations"]["credstash-resourceversion"] == "10"
+    assert cont.secrets.get("test", "boom").metadata.resource_version == "8"
+
+
+@patch("controller.CredStashController.prefetch_materials", return_value={})
+@patch("controller.credstash.getSecret", return_value="123")
+def test_update_secret_patches_changes_only(
+    credstash_get_secret_mock, _, engine
+):
+    cont = engine("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    current = managed_secret(
+        "boom",
+        "test",
+        "7",
+        {"credstash-fully-managed": "true", "credstash-resourceversion": "9"},
+    )
+    current.data = {"lala": "MTIz", "old": "b2xk"}
+    cont.secrets.replace([current])
+    credstash_secret = {
+        "metadata": {"namespace": "test", "name": "boom"},
+        "spec": [
+            {"from": "ba", "name": "lala", "version": "0001"},
+            {"from": "bo", "name": "new", "version": "0001"},
+        ],
+    }
+    cont.update_secret(credstash_secret, resource_version=10)
+
+    # Unchanged keys aren't sent, dropped ones are removed
+    assert cont.v1core.patch_namespaced_secret.call_args[0][2] == {
+        "data": {"new": "MTIz", "old": None},
+        "metadata": {
+            "annotations": {
+                "credstash-resourceversion": "10",
+                "credstash-spec-hash": ANY,
+            }
+        },
+    }
+
+def test_delete_secret_reads_from_store(engine):
+    cont = engine("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    cont.secrets.replace([managed_secret("boom", "test", "7")])
+    credstash_secret = {"metadata": {"namespace": "test", "name": "boom"}}
+    cont.delete_secret(credstash_secret, resource_version=10)
+
+    cont.v1core.read_namespaced_secret.assert_not_called()
+    cont.v1core.delete_namespaced_secret.assert_called_once_with(
+        "boom", "test", V1DeleteOptions()
+    )
+    assert cont.secrets.get("test", "boom") is None
+
+
+class StopWatching(BaseException):
+    pass
+
+
+@patch("controller.watch.Watch")
+def test_watch_secrets(watch_mock):
+    cont = CredStashController("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    cont.v1core.list_secret_for_all_namespaces.return_value = V1SecretList(
+        items=[managed_secret("a", "ns", "1"), managed_secret("b", "ns", "2")],
+        metadata=V1ListMeta(resource_version="2"),
+    )
+
+    def stream(*args, **kwargs):
+        yield {"type": "DELETED", "object": managed_secret("a", "ns", "3")}
+        yield {"type": "ADDED", "object": managed_secret("c", "ns", "4")}
+        raise StopWatching()
+
+    watch_mock.return_value.stream.side_effect = stream
+    with pytest.raises(StopWatching):
+        cont.watch_secrets()
+
+    assert cont.secrets.synced.is_set()
+    assert cont.secrets.get("ns", "a") is None
+    assert cont.secrets.get("ns", "b") is not None
+    assert cont.secrets.get("ns", "c") is not None
+    assert watch_mock.return_value.stream.call_args[1] == {
+        "label_selector": "credstash.local/managed=true",
+        "resource_version": "2",
+    }
+
+
+def test_watch_credstash_secrets():
+    cont = CredStashController("none", "none", "none", "none", "*")
+    cont.crds = MagicMock()
+    response = cont.crds.api_client.call_api.return_value
+    response.read_chunked.return_value = [
+        b'{"type": "BOOKMARK", "object": {"metadata": ',
+        b'{"resourceVersion": "5"}}}\n{"type": "ADDED", "object": {}}\n',
+    ]
+
+    events = list(cont.watch_credstash_secrets("3"))
+
+    assert [event["type"] for event in events] == ["BOOKMARK", "ADDED"]
+    args = cont.crds.api_client.call_api.call_args[0]
+    assert args[3] == [
+        ("watch", "true"),
+        ("allowWatchBookmarks", "true"),
+        ("resourceVersion", "3"),
+    ]
+    response.release_conn.assert_called_once()
+
+
+def test_main_loop_resumes_from_last_resource_version():
+    cont = CredStashController("none", "none", "none", "none", "*")
+    cont._init_client = MagicMock()
+    cont.start_workers = MagicMock()
+    cont.start_secret_watch = MagicMock()
+    cont.start_latest_poller = MagicMock()
+    cont.initial_sync = MagicMock(side_effect=["8", "20"])
+    cont.enqueue_event = MagicMock()
+    added = {
+        "type": "ADDED",
+        "object": {
+            "spec": [{"name": "lala"}],
+            "metadata": {
+                "namespace": "boom",
+                "name": "boom",
+                "resourceVersion": "10",
+            },
+        },
+    }
+    bookmark = {
+        "type": "BOOKMARK",
+        "object": {"metadata": {"resourceVersion": "12"}},
+    }
+    forbidden = {"type": "ERROR", "object": {"code": 403}}
+    gone = {"type": "ERROR", "object": {"code": 410}}
+    streams = [[added, bookmark], [forbidden], [gone], StopWatching()]
+
+    def watch_credstash_secrets(resource_version, namespace):
+        stream = streams.pop(0)
+        if isinstance(stream, BaseException):
+            raise stream
+        return iter(stream)
+
+    cont.watch_credstash_secrets = MagicMock(
+        side_effect=watch_credstash_secrets
+    )
+    with patch("controller.time.sleep") as sleep_mock:
+        with pytest.raises(StopWatching):
+            cont.main_loop()
+
+    assert cont.watch_credstash_secrets.call_args_list == [
+        call("8", namespace=None),
+        call("12", namespace=None),
+        call("12", namespace=None),
+        call("20", namespace=None),
+    ]
+    assert cont.initial_sync.call_count == 2
+    # Only the 403 backs off, the 410 relists straight away
+    sleep_mock.assert_called_once_with(1)
+    cont.enqueue_event.assert_called_once_with(added, "10")
+
+
+def test_initial_sync_reconciles_out_of_date():
+    cont = CredStashController("none", "none", "none", "none", "*")
+    cont.crds = MagicMock()
+    cont.secrets.replace(
+        [
+            managed_secret(
+                "current", "ns", "1", {"credstash-resourceversion": "10"}
+            ),
+            managed_secret(
+                "stale", "ns", "1", {"credstash-resourceversion": "10"}
+            ),
+            managed_secret(
+                "garbled", "ns", "1", {"credstash-resourceversion": "x"}
+            ),
+        ]
+    )
+
+    def credstash_secret(name, resource_version):
+        return {
+            "metadata": {
+                "namespace": "ns",
+                "name": name,
+                "resourceVersion": resource_version,
+            },
+            "spec": [{"from": "ba", "name": "lala", "version": "0001"}],
+        }
+
+    cont.crds.api_client.call_api.side_effect = [
+        {
+            "metadata": {"continue": "abc", "resourceVersion": "30"},
+            "items": [
+                credstash_secret("current", "10"),
+                credstash_secret("stale", "11"),
+            ],
+        },
+        {
+            "metadata": {"resourceVersion": "30"},
+            "items": [
+                credstash_secret("new", "12"),
+                credstash_secret("garbled", "13"),
+            ],
+        },
+    ]
+    cont.enqueue_event = MagicMock()
+
+    assert cont.initial_sync() == "30"
+
+    assert [
+        args[0][0]["object"]["metadata"]["name"]
+        for args in cont.enqueue_event.call_args_list
+    ] == ["stale", "new", "garbled"]
+    assert cont.crds.api_client.call_api.call_args_list[1][0][3] == [
+        ("limit", 500),
+        ("continue", "abc"),
+    ]
+
+
+def test_initial_sync_waits_only_for_its_own_keys():
+    cont = CredStashController("none", "none", "none", "none", "*")
+    cont.crds = MagicMock()
+    cont.secrets.replace([])
+    cont.crds.api_client.call_api.return_value = {
+        "metadata": {"resourceVersion": "5"},
+        "items": [
+            {
+                "metadata": {
+                    "namespace": "ns",
+                    "name": "a",
+                    "resourceVersion": "5",
+                },
+                "spec": [{"from": "ba", "name": "lala", "version": "0001"}],
+            }
+        ],
+    }
+    # Another namespace's event that is still being handled
+    cont.queue.put("other/b", "event")
+    cont.queue.get()
+
+    def worker():
+        key, _ = cont.queue.get()
+        cont.queue.done(key)
+
+    threading.Thread(target=worker, daemon=True).start()
+    synced = []
+    sync = threading.Thread(
+        target=lambda: synced.append(cont.initial_sync()), daemon=True
+    )
+    sync.start()
+    sync.join(5)
+
+    assert synced == ["5"]
+
+
+@patch("controller.time.sleep")
+@patch("controller.watch.Watch")
+def test_watch_secrets_unsynced_while_relisting(watch_mock, sleep_mock):
+    cont = CredStashController("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    secret_list = V1SecretList(
+        items=[managed_secret("a", "ns", "1")],
+        metadata=V1ListMeta(resource_version="1"),
+    )
+    synced = []
+
+    def list_secrets(**kwargs):
+        synced.append(cont.secrets.synced.is_set())
+        if len(synced) == 3:
+            raise StopWatching()
+        return secret_list
+
+    cont.v1core.list_secret_for_all_namespaces.side_effect = list_secrets
+    streams = [
+        iter([{"type": "ERROR", "raw_object": {"code": 410}}]),
+        RuntimeError("connection reset"),
+    ]
+    watch_mock.return_value.stream.side_effect = streams
+
+    with pytest.raises(StopWatching):
+        cont.watch_secrets()
+
+    assert synced == [False, False, False]
+    sleep_mock.assert_called_once_with(5)
+    cont.v1core.read_namespaced_secret.return_value = "from the api"
+    assert cont.read_secret("a", "ns") == "from the api"
+
+
+@patch("controller.watch.Watch")
+def test_watch_secrets_repairs_drift(watch_mock):
+    cont = CredStashController("none", "none", "none", "none", "*")
+    cont.v1core = MagicMock()
+    cont.crds = MagicMock()
+    cont.enqueue_event = MagicMock()
+    hashed = {"credstash-fully-managed": "true", "credstash-spec-hash": "1"}
+    cont.v1core.list_secret_for_all_namespaces.return_value = V1SecretList(
+        items=[
+            managed_secret("a", "ns", "1", hashed),
+            managed_secret("b", "ns", "2", hashed),
+        ],
+        metadata=V1ListMeta(resource_version="2"),
+    )
+    edited = dict(hashed, **{"credstash-spec-hash": "edited"})
+
+    def stream(*args, **kwargs):
+        yield {"type": "DELETED", "object": managed_secret("a", "ns", "3")}
+        yield {
+            "type": "MODIFIED",
+            "object": managed_secret("b", "ns", "4", edited),
+        }
+        # Only changed by someone else the first time
+        yield {
+            "type": "MODIFIED",
+            "object": managed_secret("b", "ns", "5", edited),
+        }
+        yield {"type": "ADDED", "object": managed_secret("c", "ns", "6")}
+        raise StopWatching()
+
+    watch_mock.return_value.stream.side_effect = stream
+    cont.crds.get_namespaced_custom_object.side_effect = [
+        {"metadata": {"namespace": "ns", "name": "a"}, "spec": [{}]},
+        ApiException(status=404),
+    ]
+    with pytest.raises(StopWatching):
+        cont.watch_secrets()
+
+    assert cont.crds.get_namespaced_custom_object.call_args_list == [
+        call("credstash.local", "v1", "ns", "credstashsecrets", "a"),
+        call("credstash.local", "v1", "ns", "credstashsecrets", "b"),
+    ]
+    cont.enqueue_event.assert_called_once_with(
+        {
+            "type": "MODIFIED",
+            "object": {
+                "metadata": {"namespace": "ns", "name": "a"},
+                "spec": [{}],
+            },
+        }
+    )
+
+
+def test_own_write_seen_on_watch_first_isnt_drift():
+    cont = CredStashController("none", "none", "none", "none", "*")
+    cont.v1core = MagicMock()
+    before = {"credstash-fully-managed": "true", "credstash-spec-hash": "1"}
+    after = dict(before, **{"credstash-spec-hash": "2"})
+    current = managed_secret("a", "ns", "1", before)
+    cont.secrets.replace([current])
+    desired = managed_secret("a", "ns", "1", after)
+    desired.data = {"KEY": "dmFsdWU="}
+    seen = []
+
+    def patch_secret(name, namespace, patch):
+        written = managed_secret("a", "ns", "2", after)
+        # The watch is quicker than the reply
+        seen.append(cont.drift_reason("MODIFIED", written))
+        return written
+
+    cont.v1core.patch_namespaced_secret.side_effect = patch_secret
+    cont.write_secret("ns", "a", desired, current)
+
+    assert seen == [None]
+    assert cont.secrets.expected_hash("ns", "a") is None
+    edited = dict(after, **{"credstash-spec-hash": "edited"})
+    assert (
+        cont.drift_reason("MODIFIED", managed_secret("a", "ns", "3", edited))
+        == "modified"
+    )
+
+    # A write that failed isn't expected any more
+    cont.v1core.patch_namespaced_secret.side_effect = ApiException(status=422)
+    cont.write_secret("ns", "a", desired, current)
+    assert cont.secrets.expected_hash("ns", "a") is None
+
+
+@patch("controller.time.sleep")
+@patch("controller.watch.Watch")
+def test_watch_secrets_repairs_deleted_while_relisting(
+    watch_mock, sleep_mock
+):
+    cont = CredStashController("none", "none", "none", "none", "*")
+    cont.v1core = MagicMock()
+    cont.crds = MagicMock()
+    cont.repair_drift = MagicMock()
+    cont.secrets.replace(
+        [managed_secret("a", "ns", "1"), managed_secret("b", "ns", "2")]
+    )
+    cont.v1core.list_secret_for_all_namespaces.return_value = V1SecretList(
+        items=[managed_secret("b", "ns", "2")],
+        metadata=V1ListMeta(resource_version="3"),
+    )
+    watch_mock.return_value.stream.side_effect = StopWatching()
+
+    with pytest.raises(StopWatching):
+        cont.watch_secrets()
+
+    cont.repair_drift.assert_called_once_with("ns", "a")
+
+
+def test_update_secret_recreates_deleted_secret(engine):
+    cont = engine("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret.side_effect = ApiException(status=404)
+    credstash_secret = {
+        "metadata": {
+            "namespace": "test",
+            "name": "boom",
+            "resourceVersion": "7",
+        },
+        "spec": [],
+    }
+    cont.update_secret(credstash_secret, None)
+
+    created = cont.v1core.create_namespaced_secret.call_args[0][1]
+    assert created.metadata.annotations["credstash-resourceversion"] == "7"
+
+
+@patch("controller.credstash.getSecret", return_value="123")
+def test_update_secret_skips_unchanged_spec(credstash_get_secret_mock, engine):
+    cont = engine("none", "none", "none", "default", "none")
+    cont.v1core = MagicMock()
+    spec = [{"from": "ba", "name": "lala", "version": "0001"}]
+    spec_hash = cont.spec_hash(spec)
+    # Spelling out the default table doesn't change what gets fetched
+    assert spec_hash == cont.spec_hash(
+        [{"from": "ba", "name": "lala", "version": "0001", "table": "default"}]
+    )
+    assert spec_hash != cont.spec_hash(
+        [{"from": "ba", "name": "lala", "version": "0002"}]
+    )
+    cont.secrets.replace(
+        [
+            managed_secret(
+                "boom",
+                "test",
+                "7",
+                {
+                    "credstash-fully-managed": "true",
+                    "credstash-resourceversion": "5",
+                    "credstash-spec-hash": spec_hash,
+                },
+            )
+        ]
+    )
+    credstash_secret = {
+        "metadata": {"namespace": "test", "name": "boom"},
+        "spec": spec,
+    }
+    cont.update_secret(credstash_secret, resource_version=10)
+
+    credstash_get_secret_mock.assert_not_called()
+    cont.v1core.patch_namespaced_secret.assert_not_called()
+
+    credstash_secret["spec"] = [
+        {"from": "ba", "name": "lala", "version": "0002"}
+    ]
+    cont.update_secret(credstash_secret, resource_version=11)
+    credstash_get_secret_mock.assert_called_once()
+    assert cont.v1core.patch_namespaced_secret.call_args[0][2]["metadata"][
+        "annotations"
+    ]["credstash-spec-hash"] == cont.spec_hash(credstash_secret["spec"])
+
+
+def test_main_loop_watches_allowed_namespaces():
+    cont = CredStashController("none", "none", "none", "none", "one,two")
+    cont._init_client = MagicMock()
+    cont.start_workers = MagicMock()
+    cont.start_secret_watch = MagicMock()
+    cont.start_latest_poller = MagicMock()
+    cont.watch_loop = MagicMock()
+
+    cont.main_loop()
+
+    assert sorted(cont.watch_loop.call_args_list) == [
+        call("one"),
+        call("two"),
+    ]
+
+
+def test_hash_ring_moves_few_namespaces():
+    namespaces = ["ns{}".format(i) for i in range(1000)]
+    before = HashRing(["a", "b", "c"])
+    after = HashRing(["a", "b", "c", "d"])
+
+    owners = collections.Counter(before.owner(ns) for ns in namespaces)
+    assert all(200 < owners[member] < 470 for member in "abc")
+    moved = [ns for ns in namespaces if before.owner(ns) != after.owner(ns)]
+    # Only what the new replica takes over moves
+    assert all(after.owner(ns) == "d" for ns in moved)
+    assert 150 < len(moved) < 350
+
+
+def lease(holder, seconds_ago, duration=15):
+    renewed = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=seconds_ago
+    )
+    return {
+        "metadata": {
+            "name": "credstash-controller-" + holder,
+            "resourceVersion": "1",
+        },
+        "spec": {
+            "holderIdentity": holder,
+            "leaseDurationSeconds": duration,
+            "renewTime": renewed.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        }
+    }
+
+
+def test_update_shard():
+    cont = CredStashController(
+        "none", "none", "none", "none", "*", shard_identity="a"
+    )
+    cont.crds = MagicMock()
+    call_api = cont.crds.api_client.call_api
+    call_api.side_effect = [
+        ApiException(status=404),
+        {},
+        {
+            "items": [
+                lease("a", 0),
+                lease("b", 5),
+                lease("c", 20),
+                lease("d", 60),
+            ]
+        },
+        {},
+    ]
+
+    assert cont.update_shard()
+
+    # The lease didn't exist yet, so it was created
+    assert [c[0][1] for c in call_api.call_args_list] == [
+        "PATCH",
+        "POST",
+        "GET",
+        "DELETE",
+    ]
+    assert call_api.call_args_list[1][1]["body"]["metadata"] == {
+        "name": "credstash-controller-a",
+        "labels": {"credstash.local/shard-member": "true"},
+    }
+    # c and d stopped renewing their leases, d's is long gone
+    assert cont.ring.members == ["a", "b"]
+    assert call_api.call_args_list[3][0][2] == {
+        "namespace": "kube-system",
+        "name": "credstash-controller-d",
+    }
+    assert call_api.call_args_list[3][1]["body"] == {
+        "preconditions": {"resourceVersion": "1"}
+    }
+    owned = [ns for ns in ("one", "two", "three", "four") if cont.owns(ns)]
+    assert owned == [
+        ns
+        for ns in ("one", "two", "three", "four")
+        if HashRing(["a", "b"]).owner(ns) == "a"
+    ]
+
+    call_api.side_effect = [{}, {"items": [lease("a", 0), lease("b", 1)]}]
+    assert not cont.update_shard()
+
+    # Events were dropped while the lease had lapsed
+    cont.lease_expires = time.monotonic() - 1
+    call_api.side_effect = [{}, {"items": [lease("a", 0), lease("b", 1)]}]
+    assert cont.update_shard()
+    assert cont.owns(owned[0])
+
+
+def test_release_lease():
+    cont = CredStashController(
+        "none", "none", "none", "none", "*", shard_identity="a"
+    )
+    cont.crds = MagicMock()
+    call_api = cont.crds.api_client.call_api
+    cont.release_lease()
+    call_api.assert_not_called()
+
+    cont.lease_expires = time.monotonic() + 15
+    cont.release_lease()
+    assert call_api.call_args[0][1:3] == (
+        "DELETE",
+        {"namespace": "kube-system", "name": "credstash-controller-a"},
+    )
+    assert not cont.owns("one")
+
+
+def test_main_loop_releases_lease():
+    cont = CredStashController(
+        "none", "none", "none", "none", "*", shard_identity="a"
+    )
+    for method in (
+        "start_workers",
+        "_init_client",
+        "start_secret_watch",
+        "start_sharding",
+        "start_latest_poller",
+        "release_lease",
+    ):
+        setattr(cont, method, MagicMock())
+    cont.watch_loop = MagicMock(side_effect=SystemExit(0))
+
+    with pytest.raises(SystemExit):
+        cont.main_loop()
+    cont.release_lease.assert_called_once_with()
+
+
+def test_resync_runs_apart_from_lease_renewal():
+    cont = CredStashController(
+        "none", "none", "none", "none", "one,two", shard_identity="a"
+    )
+    started = threading.Event()
+    release = threading.Event()
+    synced = []
+
+    def initial_sync(namespace=None):
+        started.set()
+        release.wait(5)
+        synced.append(namespace)
+
+    cont.initial_sync = initial_sync
+    cont.request_resync()
+    assert started.wait(5)
+    # Requested again while catching up, so it runs once more afterwards
+    cont.request_resync()
+    cont.request_resync()
+    release.set()
+    for _ in range(100):
+        if cont.resync_thread is None:
+            break
+        time.sleep(0.05)
+
+    assert cont.resync_thread is None
+    assert synced == ["one", "two", "one", "two"]
+
+
+def test_owns_nothing_after_lease_lapses():
+    cont = CredStashController(
+        "none", "none", "none", "none", "*", shard_identity="a"
+    )
+    cont.ring = HashRing(["a"])
+    cont.lease_expires = time.monotonic() + 15
+    assert cont.owns("one")
+    cont.lease_expires = time.monotonic() - 1
+    assert not cont.owns("one")
+
+
+def test_process_event_other_shard(engine):
+    controller = engine(
+        "none", "none", "none", "none", "*", shard_identity="a"
+    )
+    controller.ring = HashRing(["b"])
+    controller.lease_expires = time.monotonic() + 15
+    update_secret = mock_update_secret(controller)
+
+    controller.process_event(
+        {
+            "object": {
+                "spec": {"boom"},
+                "metadata": {"namespace": "boom", "name": "test"},
+            },
+            "type": "ADDED",
+        }
+    )
+    update_secret.assert_not_called()
+
+def test_watch_credstash_secrets_in_namespace():
+    cont = CredStashController("none", "none", "none", "none", "one")
+    cont.crds = MagicMock()
+    cont.crds.api_client.call_api.return_value.read_chunked.return_value = []
+
+    list(cont.watch_credstash_secrets("3", namespace="one"))
+
+    args = cont.crds.api_client.call_api.call_args[0]
+    assert args[0] == "/apis/{group}/{version}/namespaces/{namespace}/{plural}"
+    assert args[2]["namespace"] == "one"
+
+
+@patch("controller.credstash.getSecret", return_value="123")
+def test_update_secret_latest_version(credstash_get_secret_mock, engine):
+    cont = engine("none", "none", "none", "none", "none")
+    cont.v1core = MagicMock()
+    cont.v1core.read_namespaced_secret = MagicMock(
+        side_effect=ApiException(status=404)
+    )
+    cont.highest_version = MagicMock(return_value="0000000000000000003")
+    credstash_secret = {
+        "metadata": {"namespace": "test", "name": "boom"},
+        "spec": [
+            {"from": "ba", "name": "lala"},
+            {"from": "bo", "name": "lala2", "version": "latest"},
+            {"from": "bi", "name": "lala3", "version": "0001"},
+        ],
+    }
+    with patch.object(cont, "prefetch_materials", return_value={}):
+        cont.update_secret(credstash_secret, resource_version=1)
+
+    assert sorted(
+        (args[1]["name"], args[1]["version"])
+        for args in credstash_get_secret_mock.call_args_list
+    ) == [
+        ("ba", "0000000000000000003"),
+        ("bi", "0001"),
+        ("bo", "0000000000000000003"),
+    ]
+    assert sorted(cont.highest_version.call_args_list) == [
+        call("none", "ba"),
+        call("none", "bo"),
+    ]
+    assert not cont.is_up_to_date(credstash_secret)
+
+
+def test_poll_latest_versions():
+    cont = CredStashController("none", "none", "none", "none", "*")
+    versions = {("none", "ba"): "0001", ("none", "bo"): "0001"}
+    cont.highest_version = MagicMock(
+        side_effect=lambda table, name: versions[table, name]
+    )
+    cont.enqueue_event = MagicMock()
+
+    def credstash_secret(name, key):
+        return {
+            "metadata": {"namespace": "test", "name": name},
+            "spec": [{"from": key, "name": "lala"}],
+        }
+
+    first = credstash_secret("first", "ba")
+    second = credstash_secret("second", "ba")
+    third = credstash_secret("third", "bo")
+    for obj in (first, second, third):
+        cont.resolve_latest(obj)
+    cont.highest_version.reset_mock()
+
+    assert cont.poll_latest_versions() == set()
+    # A key shared by two secrets is only checked once
+    assert cont.highest_version.call_count == 2
+
+    versions[("none", "ba")] = "0002"
+    assert cont.poll_latest_versions() == {("none", "ba")}
+    assert cont.enqueue_event.call_args_list == [
+        call({"type": "MODIFIED", "object": first}),
+        call({"type": "MODIFIED", "object": second}),
+    ]
+
+    cont.untrack_latest(first)
+    cont.untrack_latest(second)
+    cont.highest_version.reset_mock()
+    cont.poll_latest_versions()
+    cont.highest_version.assert_called_once_with("none", "bo")
+
+
+def test_highest_version(credstash_table):
+    credstash_table("ba", "one", version=1)
+    credstash_table("ba", "two", version=2)
+    cont = CredStashController("none", "none", "us-east-1", "credstash", "*")
+    assert cont.highest_version("credstash", "ba") == credstash.paddedInt(2)
+    with pytest.raises(credstash.ItemNotFound):
+        cont.highest_version("credstash", "bo")
+
+
+def test_read_hedges_slow_region():
+    cont = CredStashController(
+        "none",
+        "none",
+        "us-east-1",
+        "none",
+        "*",
+        fallback_regions=["eu-west-1"],
+        hedge_delay=0.01,
+    )
+    released = threading.Event()
+
+    def read(region):
+        if region == "us-east-1":
+            released.wait(5)
+        return region
+
+    try:
+        assert cont.read("get_secret", read) == "eu-west-1"
+    finally:
+        released.set()
+    assert (cont.reads, cont.hedged_reads) == (1, 1)
+
+
+def test_read_hedges_stalled_region_under_load():
+    cont = CredStashController(
+        "none",
+        "none",
+        "us-east-1",
+        "none",
+        "*",
+        workers=1,
+        fetch_workers=2,
+        latest_poll_workers=1,
+        fallback_regions=["eu-west-1"],
+        hedge_delay=0.01,
+    )
+    released = threading.Event()
+
+    def read(region):
+        if region == "us-east-1":
+            released.wait(5)
+        return region
+
+    # More callers than there are threads for the stalled region's reads
+    callers = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+    try:
+        started = time.monotonic()
+        results = list(
+            callers.map(
+                lambda i: cont.read("get_secret", read), range(32)
+            )
+        )
+        assert time.monotonic() - started < 2
+    finally:
+        released.set()
+        callers.shutdown()
+    assert results == ["eu-west-1"] * 32
+    assert (cont.reads, cont.hedged_reads) == (32, 32)
+
+
+def test_hedged_clients_time_out():
+    cont = CredStashController(
+        "none",
+        "none",
+        "us-east-1",
+        "none",
+        "*",
+        fallback_regions=["eu-west-1"],
+        hedge_timeout=3,
+    )
+    config = cont.aws_client("kms", "eu-west-1").meta.config
+    assert (config.connect_timeout, config.read_timeout) == (3, 3)
+    config = cont.aws_resource("dynamodb", "eu-west-1").meta.client.meta.config
+    assert (config.connect_timeout, config.read_timeout) == (3, 3)
+
+    config = CredStashController(
+        "none", "none", "us-east-1", "none", "*"
+    ).aws_client("kms").meta.config
+    assert (config.connect_timeout, config.read_timeout) == (60, 60)
+
+
+def test_read_retries_failed_region():
+    cont = CredStashController(
+        "none",
+        "none",
+        "us-east-1",
+        "none",
+        "*",
+        fallback_regions=["eu-west-1", "eu-central-1"],
+        hedge_delay=10,
+    )
+    regions = []
+
+    def read(region):
+        regions.append(region)
+        if region != "eu-central-1":
+            raise throttling_error()
+        return region
+
+    assert cont.read("get_secret", read) == "eu-central-1"
+    assert regions == ["us-east-1", "eu-west-1", "eu-central-1"]
+    # Failing over isn't hedging
+    assert (cont.reads, cont.hedged_reads) == (1, 0)
+
+    with pytest.raises(ClientError):
+        cont.read("get_secret", lambda region: read("us-east-1"))
+
+
+def test_hedge_threshold():
+    cont = CredStashController(
+        "none", "none", "none", "none", "*", fallback_regions=["other"]
+    )
+    assert cont.hedge_threshold("get_secret") == 0.2
+    for i in range(100):
+        cont.read_latencies["get_secret"].add(i / 100)
+        cont.read_latencies["batch_get_item"].add(i)
+    assert cont.hedge_threshold("get_secret") == 0.95
+    assert cont.hedge_threshold("batch_get_item") == 95
+    assert cont.hedge_threshold("decrypt") == 0.2
+
+    window = LatencyWindow(size=2)
+    assert window.percentile(0.5) is None
+    for latency in (5, 1, 2):
+        window.add(latency)
+    assert (len(window), window.percentile(0.99)) == (2, 2)
+
+
+def test_get_secret_hedged_to_replica_region():
+    moto = pytest.importorskip("moto")
+    regions = ["us-east-1", "eu-west-1"]
+    with moto.mock_aws():
+        for region in regions:
+            session = boto3.Session(
+                aws_access_key_id="none",
+                aws_secret_access_key="none",
+                region_name=region,
+            )
+            credstash.get_session._cached_session = session
+            kms = session.client("kms")
+            key_id = kms.create_key()["KeyMetadata"]["KeyId"]
+            kms.create_alias(AliasName="alias/credstash", TargetKeyId=key_id)
+            credstash.createDdbTable(region=region, table="credstash")
+            credstash.putSecret(
+                "a",
+                "value",
+                version=credstash.paddedInt(1),
+                region=region,
+                table="credstash",
+            )
+        credstash.get_session._cached_session = None
+
+        cont = CredStashController(
+            "none",
+            "none",
+            "us-east-1",
+            "credstash",
+            "*",
+            fallback_regions=["eu-west-1"],
+            hedge_delay=0.05,
+        )
+        aws_resource = cont.aws_resource
+
+        def slow_primary(service, region=None):
+            # The primary region is degraded
+            if region == "us-east-1":
+                time.sleep(1)
+            return aws_resource(service, region)
+
+        cont.aws_resource = slow_primary
+        hedged = metric(
+            "credstash_controller_region_reads_total",
+            region="eu-west-1",
+            hedged="true",
+        )
+
+        started = time.monotonic()
+        assert (
+            cont.get_secret("credstash", "a", credstash.paddedInt(1))
+            == "value"
+        )
+        assert time.monotonic() - started < 1
+        assert (
+            metric(
+                "credstash_controller_region_reads_total",
+                region="eu-west-1",
+                hedged="true",
+            )
+            == hedged + 1
+        )
+        for pool in cont.region_pools.values():
+            pool.shutdown()
+
+
+def metric(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@patch("controller.credstash.getSecret", return_value="123")
+def test_metrics(credstash_get_secret_mock):
+    cont = CredStashController("none", "none", "none", "none", "*")
+    cont.v1core = MagicMock()
+    metadata = V1ObjectMeta(
+        name="boom",
+        namespace="test",
+        annotations={
+            "credstash-fully-managed": "true",
+            "credstash-resourceversion": "5",
+        },
+    )
+    cont.v1core.read_namespaced_secret = MagicMock(
+        return_value=V1Secret("v1", {}, "Secret", metadata)
+    )
+    event = {
+        "object": {
+            "spec": [{"from": "ba", "name": "lala", "version": "0001"}],
+            "metadata": {"namespace": "test", "name": "boom"},
+        },
+        "type": "MODIFIED",
+    }
+    before = {
+        "fetch": metric(
+            "credstash_controller_credstash_seconds_count", call="get_secret"
+        ),
+        "read": metric(
+            "credstash_controller_secret_api_seconds_count", call="read"
+        ),
+        "patch": metric(
+            "credstash_controller_secret_api_seconds_count", call="patch"
+        ),
+        "ok": metric(
+            "credstash_controller_events_total",
+            type="MODIFIED",
+            outcome="ok",
+        ),
+        "skipped": metric(
+            "credstash_controller_events_already_processed_total"
+        ),
+    }
+
+    cont.enqueue_event(event, "6")
+    assert metric("credstash_controller_queue_depth") == 1
+    cont.start_workers()
+    cont.queue.join()
+
+    assert metric(
+        "credstash_controller_credstash_seconds_count", call="get_secret"
+    ) == before["fetch"] + 1
+    assert metric(
+        "credstash_controller_secret_api_seconds_count", call="read"
+    ) == before["read"] + 1
+    assert metric(
+        "credstash_controller_secret_api_seconds_count", call="patch"
+    ) == before["patch"] + 1
+    assert metric(
+        "credstash_controller_events_total", type="MODIFIED", outcome="ok"
+    ) == before["ok"] + 1
+    assert metric("credstash_controller_queue_depth") == 0
+
+    cont.update_secret(event["object"], "4")
+    assert metric(
+        "credstash_controller_events_already_processed_total"
+    ) == before["skipped"] + 1
+
+
+class RecordingController:
+    def __init__(self, *args, results=None, delay=0, **kwargs):
+        self.results = results
+        self.delay = delay
+        self.kwargs = kwargs
+        # Every event is recorded, in order
+        self.queue = WorkQueue(merge=lambda queued, new: queued + new)
+
+    def start_workers(self):
+        threading.Thread(target=self.work, daemon=True).start()
+
+    def work(self):
+        while True:
+            key, events = self.queue.get()
+            for name, resource_version in events:
+                time.sleep(self.delay)
+                self.results.put((os.getpid(), name, resource_version))
+            self.queue.done(key)
+
+    def _init_client(self):
+        pass
+
+    def start_secret_watch(self):
+        raise AssertionError("Only the supervisor watches secrets")
+
+    def start_latest_poller(self):
+        pass
+
+    def enqueue_event(self, event, resource_version=None):
+        metadata = event["object"]["metadata"]
+        self.queue.put(
+            "{}/{}".format(metadata["namespace"], metadata["name"]),
+            [(metadata["name"], resource_version)],
+        )
+
+
+def test_multi_process_controller():
+    results = multiprocessing.get_context("spawn").Queue()
+    cont = MultiProcessController(
+        "none",
+        "none",
+        "none",
+        "none",
+        "*",
+        shard_identity="a",
+        rate_limits={"kms": 10},
+        processes=2,
+        engine=RecordingController,
+        engine_options={"results": results},
+    )
+    assert cont.worker_kwargs["shard_identity"] is None
+    assert cont.worker_kwargs["rate_limits"]["kms"] == 5
+
+    cont.start_workers()
+    try:
+        for resource_version in ("1", "2", "3"):
+            for name in ("a", "b", "c", "d"):
+                cont.enqueue_event(
+                    {
+                        "type": "MODIFIED",
+                        "object": {
+                            "spec": {"boom"},
+                            "metadata": {"namespace": "boom", "name": name},
+                        },
+                    },
+                    resource_version,
+                )
+        handled = collections.defaultdict(list)
+        for _ in range(12):
+            pid, name, resource_version = results.get(timeout=60)
+            handled[name].append((pid, resource_version))
+    finally:
+        for events in cont.event_queues:
+            events.put(None)
+        for process in cont.worker_processes:
+            process.join(10)
+
+    for name, events in handled.items():
+        # Always the same process, in the order they were seen
+        assert len({pid for pid, _ in events}) == 1
+        assert [resource_version for _, resource_version in events] == [
+            "1",
+            "2",
+            "3",
+        ]
+    assert {pid for events in handled.values() for pid, _ in events} <= {
+        process.pid for process in cont.worker_processes
+    }
+
+
+def test_multi_process_controller_waits_for_workers():
+    results = multiprocessing.get_context("spawn").Queue()
+    cont = MultiProcessController(
+        "none",
+        "none",
+        "none",
+        "none",
+        "*",
+        processes=2,
+        engine=RecordingController,
+        engine_options={"results": results, "delay": 0.2},
+    )
+    cont.start_workers()
+    try:
+        started = time.monotonic()
+        for name in ("a", "b", "c", "d"):
+            cont.enqueue_event(
+                {
+                    "type": "ADDED",
+                    "object": {
+                        "spec": {"boom"},
+                        "metadata": {"namespace": "boom", "name": name},
+                    },
+                },
+                "1",
+            )
+        cont.wait_for_events(["boom/" + name for name in "abcd"])
+        # One of them had at least two events to handle
+        assert time.monotonic() - started >= 0.4
+        assert sorted(results.get(timeout=5)[1] for _ in range(4)) == list(
+            "abcd"
+        )
+        cont.wait_for_events([])
+    finally:
+        for events in cont.event_queues:
+            events.put(None)
+        for process in cont.worker_processes:
+            process.join(10)
@@ -0,0 +1,50 @@
+from importtime import check, measure, parse_importtime, report
+
+OUTPUT = """\
+import time: self [us] | cumulative | imported package
+import time:        10 |         10 |   posix
+import time:        30 |         40 | os
+import time:       150 |        150 |   _io
+import time:        20 |         50 |     json.decoder
+import time:        40 |         90 |   json
+import time:       300 |        540 | controller
+"""
+
+
+def test_parse_importtime():
+    assert parse_importtime(OUTPUT) == [
+        ("posix", 10, 10, 1),
+        ("os", 30, 40, 0),
+        ("_io", 150, 150, 1),
+        ("json.decoder", 20, 50, 2),
+        ("json", 40, 90, 1),
+        ("controller", 300, 540, 0),
+    ]
+
+
+def test_report():
+    result = report("controller", [parse_importtime(OUTPUT)])
+
+    assert result["total_ms"] == 0.5
+    assert result["self_ms"] == 0.3
+    # Only what the module itself imported
+    assert [heavy["module"] for heavy in result["heaviest"]] == [
+        "_io",
+        "json",
+    ]
+
+
+def test_check():
+    result = report("controller", [parse_importtime(OUTPUT)])
+
+    assert check(result, target_ms=1, max_modules=6) == []
+    assert check(result, target_ms=0.4, max_modules=5) == [
+        "import controller took 0.5ms, the target is 0.4ms",
+        "import controller loaded 6 modules, the most allowed is 5",
+    ]
+
+
+def test_measure():
+    result = report("json", measure("json", runs=1))
+    assert result["runs"] == 1
+    assert result["total_ms"] > 0
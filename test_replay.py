@@ -0,0 +1,117 @@
+import pytest
+from unittest.mock import MagicMock
+
+pytest.importorskip("moto")
+
+from benchmark import ENGINES  # noqa: E402
+from replay import load, record, redact, replay, stand_in_secrets  # noqa: E402
+
+
+def credstash_secret(name, resource_version, *keys):
+    return {
+        "apiVersion": "credstash.local/v1",
+        "kind": "CredStashSecret",
+        "metadata": {
+            "namespace": "ns",
+            "name": name,
+            "resourceVersion": resource_version,
+            "uid": "uid-" + name,
+            "annotations": {"kubectl.kubernetes.io/last-applied": "{}"},
+        },
+        "spec": [
+            {"name": key.upper(), "from": key, "version": "latest"}
+            for key in keys
+        ],
+    }
+
+
+def test_redact():
+    obj = credstash_secret("a", "1", "key")
+    obj["spec"][0]["value"] = "hunter2"
+
+    assert redact(obj) == {
+        "metadata": {
+            "namespace": "ns",
+            "name": "a",
+            "resourceVersion": "1",
+            "uid": "uid-a",
+        },
+        "spec": [{"name": "KEY", "from": "key", "version": "latest"}],
+    }
+
+
+@pytest.fixture
+def recording(tmp_path):
+    controller = MagicMock()
+    controller.list_credstash_secrets.return_value = [
+        {
+            "metadata": {"resourceVersion": "1"},
+            "items": [credstash_secret("a", "1", "shared", "a")],
+        }
+    ]
+    controller.watch_credstash_secrets.side_effect = [
+        iter(
+            [
+                {"type": "ADDED", "object": credstash_secret("b", "2", "b")},
+                {
+                    "type": "BOOKMARK",
+                    "object": {"metadata": {"resourceVersion": "3"}},
+                },
+            ]
+        ),
+        iter(
+            [
+                {
+                    "type": "MODIFIED",
+                    "object": credstash_secret("b", "4", "shared", "b"),
+                },
+                {
+                    "type": "DELETED",
+                    "object": credstash_secret("a", "5", "shared", "a"),
+                },
+                {"type": "ERROR", "object": {"message": "too old"}},
+            ]
+        ),
+    ]
+    path = str(tmp_path / "recording.jsonl.gz")
+
+    assert record(controller, path, include_existing=True) == 4
+    # The watch resumes from the bookmark
+    assert controller.watch_credstash_secrets.call_args_list[1][0] == ("3",)
+    return path
+
+
+def test_record(recording):
+    events = load(recording)
+
+    assert [event["type"] for event in events] == [
+        "ADDED",
+        "ADDED",
+        "MODIFIED",
+        "DELETED",
+    ]
+    assert "annotations" not in events[0]["object"]["metadata"]
+    assert stand_in_secrets(events) == [
+        ("credential-store", key, "0000000000000000001")
+        for key in ("a", "b", "shared")
+    ]
+
+
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_replay(recording, engine):
+    # Long enough for the whole burst to be merged in the queue
+    result = replay(
+        load(recording),
+        workers=2,
+        debounce=0.5,
+        controller_factory=ENGINES[engine],
+    )
+
+    assert result["types"] == {"ADDED": 2, "MODIFIED": 1, "DELETED": 1}
+    assert result["coalesced"] == 2
+    assert result["kubernetes_calls"] == {
+        "read_namespaced_secret": 2,
+        "create_namespaced_secret": 1,
+    }
+    assert result["aws_calls"]["kms:Decrypt"] == 2
+    assert result["max_ms"] >= result["p99_ms"] >= result["p50_ms"]